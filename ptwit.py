@@ -9,12 +9,38 @@ from string import Formatter
 import json
 import re
 import configparser
+import shlex
+import subprocess
+from contextlib import contextmanager
+from collections import Counter
+from itertools import chain, groupby
+import sqlite3
+import heapq
+import queue
+import random
+import time
+import threading
+import csv
+import hashlib
+import tempfile
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from html import unescape as html_unescape
-from urllib.parse import parse_qsl
+from urllib.parse import parse_qsl, urlparse
 import typing as T
 
 import twitter
 import click
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
 from click_default_group import DefaultGroup
 from requests_oauthlib import OAuth1Session
 from requests_oauthlib.oauth1_session import TokenRequestDenied
@@ -22,6 +48,29 @@ from requests_oauthlib.oauth1_session import TokenRequestDenied
 
 __version__ = "0.3"
 MAX_COUNT = 200
+MAX_SEARCH_COUNT = 100
+MAX_WORKERS = 8
+MAX_CACHED_STATUSES = 10000
+MAX_LOOKUP_COUNT = 100
+# A refresh lock older than this (in seconds) is left by a dead process
+STALE_LOCK_AGE = 600
+MAX_MEDIA_CACHE_SIZE = 1024 * 1024 * 1024
+MAX_RETRIES = 3
+HTTP_POOL_SIZE = 16
+# Below this number of tweets, parallel rendering is not worth
+# starting a process pool
+PARALLEL_RENDER_THRESHOLD = 500
+HTTP_CONNECT_TIMEOUT = 10.0
+HTTP_READ_TIMEOUT = 60.0
+# Twitter error codes worth retrying: over capacity and internal
+# error. Rate limit exceeded (88) is not, since the window lasts 15
+# minutes
+TRANSIENT_ERROR_CODES = {130, 131}
+TRANSIENT_ERROR_MESSAGES = {
+    "Capacity Error",
+    "Technical Error",
+    "Exceeded connection limit for user",
+}
 
 
 class DefaultFormatter(Formatter):
@@ -33,8 +82,68 @@ class DefaultFormatter(Formatter):
             return None
 
 
+class JitteredRetry(Retry):
+    """Retry with exponential backoff randomized by up to 50%."""
+
+    def get_backoff_time(self) -> float:
+        return super().get_backoff_time() * random.uniform(0.5, 1.5)
+
+
+class TransportAdapter(HTTPAdapter):
+    """HTTP adapter with pooled keep-alive connections, default timeouts
+    and retries of idempotent GETs. Mount one instance on every session
+    to share its connection pools."""
+
+    timeout: T.Tuple[float, float]
+
+    def __init__(
+        self,
+        pool_size: int = HTTP_POOL_SIZE,
+        connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+        read_timeout: float = HTTP_READ_TIMEOUT,
+        max_retries: int = MAX_RETRIES,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        retry = JitteredRetry(
+            total=max_retries,
+            allowed_methods=frozenset({"GET"}),
+            status_forcelist=(500, 502, 503, 504),
+            backoff_factor=0.5,
+            raise_on_status=False,
+        )
+        super().__init__(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+
+    @classmethod
+    def from_config(cls, config: "TwitterConfig") -> "TransportAdapter":
+        return cls(
+            pool_size=int(config.get("http_pool_size", default=HTTP_POOL_SIZE)),
+            connect_timeout=float(
+                config.get("http_connect_timeout", default=HTTP_CONNECT_TIMEOUT)
+            ),
+            read_timeout=float(
+                config.get("http_read_timeout", default=HTTP_READ_TIMEOUT)
+            ),
+            max_retries=int(config.get("http_max_retries", default=MAX_RETRIES)),
+        )
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+    def mount_to(self, session: requests.Session) -> requests.Session:
+        session.mount("https://", self)
+        session.mount("http://", self)
+        return session
+
+
 def fetch_access_token(
-    client_key: str, client_secret: str, trial: int = 0
+    client_key: str,
+    client_secret: str,
+    trial: int = 0,
+    adapter: T.Optional[TransportAdapter] = None,
 ) -> T.Tuple[str, str]:
     """Fetch twitter access token using oauthlib."""
 
@@ -44,6 +153,8 @@ def fetch_access_token(
 
     # Fetch request token
     oauth = OAuth1Session(client_key, client_secret=client_secret)
+    if adapter:
+        adapter.mount_to(oauth)
     fetch_response = oauth.fetch_request_token(REQUEST_TOKEN_URL)
     resource_owner_key = fetch_response.get("oauth_token")
     resource_owner_secret = fetch_response.get("oauth_token_secret")
@@ -61,6 +172,8 @@ def fetch_access_token(
         resource_owner_secret=resource_owner_secret,
         verifier=pincode,
     )
+    if adapter:
+        adapter.mount_to(oauth)
 
     # Fetch access token
     try:
@@ -68,7 +181,9 @@ def fetch_access_token(
     except TokenRequestDenied as err:
         if trial < 20:
             click.echo(err, err=True)
-            return fetch_access_token(client_key, client_secret, trial=trial + 1)
+            return fetch_access_token(
+                client_key, client_secret, trial=trial + 1, adapter=adapter
+            )
         else:
             # Do not believe it is a typo any more
             raise err
@@ -109,10 +224,13 @@ class TwitterConfig:
     general_section: str = "general"
     filename: str
     config: configparser.RawConfigParser
+    # Whether any option has changed since loaded or saved
+    changed: bool
 
     def __init__(self, filename: str):
         self.filename = filename
         self.config = configparser.RawConfigParser()
+        self.changed = False
 
         try:
             with open(self.filename) as fp:
@@ -129,14 +247,18 @@ class TwitterConfig:
 
     def set(self, option: str, value, account=None) -> "TwitterConfig":
         section = account or self.general_section
+        if self.get(option, account=account) == value:
+            return self
         if not self.config.has_section(section):
             self.config.add_section(section)
         self.config.set(section, option, value)
+        self.changed = True
         return self
 
     def unset(self, option: str, account=None) -> "TwitterConfig":
         section = account or self.general_section
-        self.config.remove_option(section, option)
+        if self.config.remove_option(section, option):
+            self.changed = True
         items = self.config.items(section)
         if not items:
             self.config.remove_section(section)
@@ -144,7 +266,8 @@ class TwitterConfig:
 
     def remove_account(self, account: str) -> "TwitterConfig":
         section = account or self.general_section
-        self.config.remove_section(section)
+        if self.config.remove_section(section):
+            self.changed = True
         return self
 
     def list_accounts(self) -> T.List[str]:
@@ -156,11 +279,512 @@ class TwitterConfig:
 
     def save(self, filename=None) -> "TwitterConfig":
         filename = filename or self.filename
-        with open(filename, "w") as fp:
-            self.config.write(fp)
+        # Write a temporary file and rename it, so that readers never
+        # see a partially written config
+        fd, tmp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as fp:
+                self.config.write(fp)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+        self.changed = False
+        return self
+
+
+class TwitterState:
+    """Volatile per-account state (e.g. since ids) stored in SQLite,
+    so that updating it neither rewrites nor risks the config file."""
+
+    filename: str
+    conn: sqlite3.Connection
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "account TEXT NOT NULL, option TEXT NOT NULL, value TEXT, "
+                "PRIMARY KEY (account, option))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS stats ("
+                "account TEXT NOT NULL, source TEXT NOT NULL, kind TEXT NOT NULL, "
+                "key TEXT NOT NULL, count INTEGER NOT NULL, "
+                "PRIMARY KEY (account, source, kind, key))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "account TEXT NOT NULL, id INTEGER NOT NULL, "
+                "partner TEXT NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (account, id))"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS messages_partner "
+                "ON messages (account, partner, id)"
+            )
+
+    def get(self, option: str, account: str, default=None):
+        row = self.conn.execute(
+            "SELECT value FROM state WHERE account = ? AND option = ?",
+            (account, option),
+        ).fetchone()
+        return default if row is None else row[0]
+
+    def set(self, option: str, value, account: str) -> "TwitterState":
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO state (account, option, value) VALUES (?, ?, ?)",
+                (account, option, str(value)),
+            )
+        return self
+
+    def unset(self, option: str, account: str) -> "TwitterState":
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM state WHERE account = ? AND option = ?",
+                (account, option),
+            )
+        return self
+
+    def add_stats(
+        self, source: str, counts: T.Mapping[T.Tuple[str, str], int], account: str
+    ) -> "TwitterState":
+        """Add counts keyed by (kind, key) to the stats of a source."""
+        rows = [(account, source, kind, key) for kind, key in counts]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO stats (account, source, kind, key, count) "
+                "VALUES (?, ?, ?, ?, 0)",
+                rows,
+            )
+            self.conn.executemany(
+                "UPDATE stats SET count = count + ? "
+                "WHERE account = ? AND source = ? AND kind = ? AND key = ?",
+                [(count,) + row for count, row in zip(counts.values(), rows)],
+            )
+        return self
+
+    def get_stats(
+        self,
+        kind: str,
+        account: str,
+        sources: T.Iterable[str],
+        limit: T.Optional[int] = None,
+    ) -> T.List[T.Tuple[str, int]]:
+        """Return (key, count) pairs of a kind summed over sources,
+        most common first."""
+        sources = list(sources)
+        placeholders = ", ".join("?" * len(sources))
+        return self.conn.execute(
+            "SELECT key, SUM(count) AS total FROM stats "
+            f"WHERE account = ? AND kind = ? AND source IN ({placeholders}) "
+            "GROUP BY key ORDER BY total DESC, key LIMIT ?",
+            [account, kind] + sources + [-1 if limit is None else limit],
+        ).fetchall()
+
+    def add_messages(
+        self, messages: T.Iterable[T.Tuple[int, str, dict]], account: str
+    ) -> "TwitterState":
+        """Store raw messages given as (id, partner screen name, data)."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO messages (account, id, partner, data) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (account, id, partner.lower(), json.dumps(data))
+                    for id, partner, data in messages
+                ],
+            )
+        return self
+
+    def get_messages(
+        self, partner: str, account: str, limit: T.Optional[int] = None
+    ) -> T.List[dict]:
+        """Return raw messages with a partner, newest first."""
+        rows = self.conn.execute(
+            "SELECT data FROM messages WHERE account = ? AND partner = ? "
+            "ORDER BY id DESC LIMIT ?",
+            (account, partner.lstrip("@").lower(), -1 if limit is None else limit),
+        )
+        return [json.loads(data) for data, in rows]
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def migrate_state(config: TwitterConfig, state: TwitterState) -> None:
+    """Move since ids from the config file into the state store."""
+    migrated = False
+    for account in config.list_accounts():
+        for option, value in config.config.items(account):
+            if not option.endswith("_since_id"):
+                continue
+            if state.get(option, account=account) is None:
+                state.set(option, value, account=account)
+            config.unset(option, account=account)
+            migrated = True
+    if migrated:
+        config.save()
+
+
+class StatusCache:
+    """A local cache of raw statuses keyed by status id, stored as JSON.
+    Inaccessible statuses are only remembered in memory, as they may
+    become accessible later, e.g. after following a protected user."""
+
+    filename: str
+    max_size: int
+    statuses: T.Dict[int, dict]
+    inaccessible: T.Set[int]
+
+    def __init__(self, filename: str, max_size: int = MAX_CACHED_STATUSES):
+        self.filename = filename
+        self.max_size = max_size
+        self.statuses = {}
+        self.inaccessible = set()
+
+        try:
+            with open(self.filename) as fp:
+                self.statuses = {
+                    int(key): value for key, value in json.load(fp).items()
+                }
+        except (IOError, ValueError):
+            pass
+
+    def get(self, status_id: int) -> T.Optional[twitter.Status]:
+        data = self.statuses.get(status_id)
+        if data is None:
+            return None
+        return twitter.Status.NewFromJsonDict(data)
+
+    def lookup(
+        self, api: twitter.Api, status_ids: T.Iterable[int]
+    ) -> T.Dict[int, T.Optional[twitter.Status]]:
+        """Return statuses by ids. Uncached ones are looked up in bulk;
+        inaccessible ones are mapped to None."""
+        status_ids = set(status_ids)
+        missing = [
+            status_id
+            for status_id in status_ids
+            if status_id not in self.statuses and status_id not in self.inaccessible
+        ]
+        if missing:
+            # GetStatuses looks up 100 statuses per request
+            found = api.GetStatuses(missing, map=True)
+            for status_id in missing:
+                status = found.get(status_id)
+                if status:
+                    self.statuses[status_id] = status._json
+                else:
+                    self.inaccessible.add(status_id)
+        return {status_id: self.get(status_id) for status_id in status_ids}
+
+    def save(self, filename=None) -> "StatusCache":
+        filename = filename or self.filename
+        # Keep the newest statuses only
+        status_ids = sorted(self.statuses, reverse=True)[: self.max_size]
+        statuses = {status_id: self.statuses[status_id] for status_id in status_ids}
+        with open(filename + ".tmp", "w") as fp:
+            json.dump(statuses, fp, ensure_ascii=False)
+        os.replace(filename + ".tmp", filename)
         return self
 
 
+class MediaCache:
+    """A content-addressed cache of downloaded media files, evicting
+    least recently used files when exceeding max_size bytes.
+
+    Processes sharing the cache merge their indices under a lock file
+    when saving, and eviction scans the directory, so files missing
+    from the index (e.g. left by a crash) are removed too.
+    """
+
+    dirname: str
+    max_size: int
+    index: T.Dict[str, str]
+
+    def __init__(self, dirname: str, max_size: int = MAX_MEDIA_CACHE_SIZE):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.index = {}
+        self.lock = threading.Lock()
+        mkdir(dirname)
+
+        self.index = self.read_index()
+
+    def read_index(self) -> T.Dict[str, str]:
+        try:
+            with open(os.path.join(self.dirname, "index.json")) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    @contextmanager
+    def locked(self) -> T.Iterator[None]:
+        """Hold the lock file of the cache directory while in context.
+        Give up waiting after a while, as a stale lock is only taken
+        over after STALE_LOCK_AGE."""
+        filename = os.path.join(self.dirname, "index.lock")
+        for _ in range(100):
+            with exclusive_lock(filename) as acquired:
+                if acquired:
+                    yield
+                    return
+            time.sleep(0.05)
+        yield
+
+    def merge_index(self) -> None:
+        """Add entries saved by other processes to the index."""
+        index = self.read_index()
+        with self.lock:
+            index.update(self.index)
+            self.index = index
+
+    def get(self, url: str) -> T.Optional[str]:
+        """Return the cached file path of the url if any."""
+        with self.lock:
+            name = self.index.get(url)
+        if name is None:
+            return None
+        path = os.path.join(self.dirname, name)
+        try:
+            # Mark it as recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def download(self, session: requests.Session, url: str) -> str:
+        """Download the url into the cache unless cached, and return
+        the file path."""
+        path = self.get(url)
+        if path is not None:
+            return path
+
+        ext = os.path.splitext(urlparse(url).path)[1]
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                with session.get(url, stream=True) as resp:
+                    resp.raise_for_status()
+                    for chunk in resp.iter_content(chunk_size=64 * 1024):
+                        digest.update(chunk)
+                        fp.write(chunk)
+            name = digest.hexdigest() + ext
+            os.replace(tmp_path, os.path.join(self.dirname, name))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        with self.lock:
+            self.index[url] = name
+        return os.path.join(self.dirname, name)
+
+    def evict(self) -> "MediaCache":
+        """Remove least recently used files until the cache fits in
+        max_size, and files not in the index, e.g. temporary files left
+        by a crash, once they are older than STALE_LOCK_AGE."""
+        with self.locked():
+            self.merge_index()
+            indexed = set(self.index.values())
+            stale_time = time.time() - STALE_LOCK_AGE
+            files = []
+            for entry in os.scandir(self.dirname):
+                if not entry.is_file() or entry.name in ("index.json", "index.lock"):
+                    continue
+                stat = entry.stat()
+                if entry.name not in indexed:
+                    # Possibly still being written by another process
+                    if stat.st_mtime < stale_time:
+                        os.remove(entry.path)
+                        continue
+                files.append((stat.st_mtime, stat.st_size, entry.name))
+
+            total_size = sum(size for _, size, _ in files)
+            for _, size, name in sorted(files):
+                if total_size <= self.max_size:
+                    break
+                os.remove(os.path.join(self.dirname, name))
+                total_size -= size
+        return self
+
+    def save(self) -> "MediaCache":
+        """Save the index merged with entries saved by other processes,
+        dropping entries of removed files."""
+        filename = os.path.join(self.dirname, "index.json")
+        with self.locked():
+            self.merge_index()
+            with self.lock:
+                self.index = {
+                    url: name
+                    for url, name in self.index.items()
+                    if os.path.exists(os.path.join(self.dirname, name))
+                }
+                index = dict(self.index)
+            fd, tmp_filename = tempfile.mkstemp(dir=self.dirname, suffix=".tmp")
+            with os.fdopen(fd, "w") as fp:
+                json.dump(index, fp)
+            os.replace(tmp_filename, filename)
+        return self
+
+
+def get_media_urls(status: twitter.Status) -> T.List[str]:
+    """Return URLs of photos and videos (the highest bitrate variant)
+    attached to a tweet or its retweeted tweet."""
+    if status.retweeted_status:
+        status = status.retweeted_status
+    urls = []
+    for media in status.media or []:
+        variants = [
+            variant
+            for variant in (media.video_info or {}).get("variants", [])
+            if variant.get("content_type") == "video/mp4"
+        ]
+        if variants:
+            urls.append(max(variants, key=lambda v: v.get("bitrate", 0))["url"])
+        elif media.media_url_https:
+            urls.append(media.media_url_https)
+    return urls
+
+
+def download_media(
+    cache: MediaCache,
+    urls: T.List[str],
+    session: requests.Session,
+    max_workers: int = MAX_WORKERS,
+) -> T.List[T.Union[str, Exception]]:
+    """Download urls into the cache concurrently with the session, and
+    return file paths, or the errors of failed downloads, in the same
+    order. The session is left open, as it may share connection pools
+    with other sessions."""
+
+    def download(url: str) -> T.Union[str, Exception]:
+        try:
+            return cache.download(session, url)
+        except (requests.RequestException, OSError) as err:
+            return err
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(download, urls))
+    finally:
+        cache.evict().save()
+
+
+def split_option(value: T.Optional[str], sep: str = ",") -> T.List[str]:
+    """Split a config value by lines and sep into a list of items."""
+    if not value:
+        return []
+    items = [item for line in value.splitlines() for item in line.split(sep)]
+    return [item.strip() for item in items if item.strip()]
+
+
+class TweetFilter:
+    """Mute rules compiled once: muted users and hashtags are looked up
+    in sets, and keywords are combined into one alternation regex so
+    each tweet is scanned once for them. Regexes are compiled on their
+    own, as inline flags and backreferences break in an alternation."""
+
+    users: T.Set[str]
+    hashtags: T.Set[str]
+    retweets_from: T.Set[str]
+    replies_from: T.Set[str]
+    patterns: T.List[T.Pattern]
+
+    def __init__(
+        self,
+        users: T.Iterable[str] = (),
+        keywords: T.Iterable[str] = (),
+        regexes: T.Iterable[str] = (),
+        hashtags: T.Iterable[str] = (),
+        retweets_from: T.Iterable[str] = (),
+        replies_from: T.Iterable[str] = (),
+    ):
+        self.users = {user.lstrip("@").lower() for user in users}
+        self.hashtags = {hashtag.lstrip("#").lower() for hashtag in hashtags}
+        # "*" mutes retweets or replies from everyone
+        self.retweets_from = {user.lstrip("@").lower() for user in retweets_from}
+        self.replies_from = {user.lstrip("@").lower() for user in replies_from}
+        self.patterns = [re.compile(regex, re.IGNORECASE) for regex in regexes]
+        keywords = list(keywords)
+        if keywords:
+            # Match whole words only, e.g. "cat" but not "concatenate"
+            alternation = "|".join(re.escape(keyword) for keyword in keywords)
+            self.patterns.insert(
+                0, re.compile(rf"(?<!\w)(?:{alternation})(?!\w)", re.IGNORECASE)
+            )
+
+    @classmethod
+    def from_config(cls, config: TwitterConfig, account: str) -> "TweetFilter":
+        def get(option, sep=","):
+            return split_option(config.get(option, account=account), sep=sep)
+
+        try:
+            return cls(
+                users=get("mute_users"),
+                keywords=get("mute_keywords"),
+                # Regexes may contain commas, so one regex per line
+                regexes=get("mute_regexes", sep="\n"),
+                hashtags=get("mute_hashtags"),
+                retweets_from=get("mute_retweets"),
+                replies_from=get("mute_replies"),
+            )
+        except re.error as err:
+            raise click.ClickException(
+                f"Invalid regex {err.pattern!r} in mute_regexes: {err}"
+            )
+
+    def __bool__(self) -> bool:
+        return bool(
+            self.users
+            or self.hashtags
+            or self.retweets_from
+            or self.replies_from
+            or self.patterns
+        )
+
+    def is_muted(self, tweet: twitter.Status) -> bool:
+        screen_name = tweet.user.screen_name.lower() if tweet.user else ""
+        if screen_name in self.users:
+            return True
+
+        retweet = tweet.retweeted_status
+        if retweet:
+            if "*" in self.retweets_from or screen_name in self.retweets_from:
+                return True
+            tweet = retweet
+            screen_name = tweet.user.screen_name.lower() if tweet.user else ""
+            if screen_name in self.users:
+                return True
+
+        if tweet.in_reply_to_status_id and (
+            "*" in self.replies_from or screen_name in self.replies_from
+        ):
+            return True
+
+        if self.hashtags and any(
+            hashtag.text.lower() in self.hashtags for hashtag in tweet.hashtags or []
+        ):
+            return True
+
+        text = html_unescape(tweet.full_text or tweet.text or "")
+        return any(pattern.search(text) for pattern in self.patterns)
+
+    def filter(self, tweets: T.Iterable[twitter.Status]) -> T.Iterator[twitter.Status]:
+        if not self:
+            yield from tweets
+            return
+        for tweet in tweets:
+            if not self.is_muted(tweet):
+                yield tweet
+
+
 # http://stackoverflow.com/a/600612/114833
 def mkdir(path: str) -> None:
     try:
@@ -184,21 +808,57 @@ def mkdir(path: str) -> None:
 @click.option(
     "--json", "format", flag_value="json", help="Print entires as JSON objects."
 )
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    type=click.IntRange(min=0),
+    help="Render large text outputs in this many processes (0 for all CPUs).",
+)
 @click.pass_context
-def ptwit(ctx: click.Context, account: T.Optional[str], format: str) -> None:
+def ptwit(ctx: click.Context, account: T.Optional[str], format: str, jobs: int) -> None:
     config_dir = click.get_app_dir("ptwit")
     mkdir(config_dir)
     config = TwitterConfig(os.path.join(config_dir, "ptwit.conf"))
+    state = TwitterState(os.path.join(config_dir, "state.sqlite3"))
+    migrate_state(config, state)
+    transport = TransportAdapter.from_config(config)
 
     if account is None:
         account = config.get("current_account")
 
     # Store the current account or user-specified account in context
     # object
-    ctx.obj = {"config": config, "account": account, "format": format}
+    ctx.obj = {
+        "config": config,
+        "state": state,
+        "transport": transport,
+        "config_dir": config_dir,
+        "account": account,
+        "format": format,
+        "jobs": jobs or os.cpu_count() or 1,
+        "max_concurrency": int(config.get("max_concurrency", default=MAX_WORKERS)),
+    }
+
+    # Serving timeline snapshots, stored messages or stats logs in
+    # only when it has to fetch
+    if ctx.invoked_subcommand == "timeline" and is_snapshot_enabled(ctx):
+        return
+    if ctx.invoked_subcommand in ("messages", "refresh-timeline", "stats"):
+        return
 
     if ctx.invoked_subcommand not in ("accounts", "login"):
-        ctx.obj["api"] = _login(config, account)
+        api_from(ctx)
+
+
+def api_from(ctx: click.Context) -> twitter.Api:
+    """Return the API of the context object, logging in if not yet."""
+    if "api" not in ctx.obj:
+        config = ctx.obj["config"]
+        ctx.obj["api"] = _login(
+            config, ctx.obj["account"], adapter=ctx.obj["transport"]
+        )
+    return ctx.obj["api"]
 
 
 def save_since_id_at(option_name: str) -> T.Callable:
@@ -212,11 +872,49 @@ def save_since_id_at(option_name: str) -> T.Callable:
                 account = config.get("current_account")
             if not account:
                 raise RuntimeError("Unable to find account anywhere")
-            config.set(option_name, results[0].id, account=account).save()
+            # Never move the mark backwards, e.g. when showing a
+            # snapshot older than a background refresh
+            state = ctx.obj["state"]
+            since_id = state.get(option_name, account=account)
+            if since_id is None or int(since_id) < results[0].id:
+                state.set(option_name, results[0].id, account=account)
 
     return save_since_id
 
 
+def count_tweets(tweets: T.Iterable[twitter.Status]) -> Counter:
+    """Count authors, hashtags, mentions and hours (UTC) of tweets."""
+    counts: Counter = Counter()
+    for tweet in tweets:
+        if tweet.user:
+            counts["author", tweet.user.screen_name] += 1
+        for hashtag in tweet.hashtags or []:
+            counts["hashtag", hashtag.text.lower()] += 1
+        for mention in tweet.user_mentions or []:
+            counts["mention", mention.screen_name] += 1
+        if tweet.created_at:
+            counts["hour", f"{parse_time(tweet.created_at).hour:02d}"] += 1
+    return counts
+
+
+def update_stats_at(source: str, option_name: str) -> T.Callable:
+    """Return a results handler adding tweets newer than the since id
+    high-water mark to the stats of source. It must run before the
+    mark is saved."""
+
+    def update_stats(ctx: click.Context, results):
+        if not results:
+            return
+        config = ctx.obj["config"]
+        state = ctx.obj["state"]
+        account = ctx.obj["account"] or config.get("current_account")
+        since_id = int(state.get(option_name, account=account, default=0))
+        new_tweets = [tweet for tweet in results if since_id < tweet.id]
+        state.add_stats(source, count_tweets(new_tweets), account=account)
+
+    return update_stats
+
+
 def handle_results(*handlers):
     def wrapper(func):
         @click.pass_context
@@ -253,7 +951,7 @@ def pass_since_id_from(option_name: str) -> T.Callable:
                 account = config.get("current_account")
             if not account:
                 raise RuntimeError("Unable to find account anywhere")
-            kwargs["since_id"] = config.get(option_name, account=account)
+            kwargs["since_id"] = ctx.obj["state"].get(option_name, account=account)
             return ctx.invoke(func, *args, **kwargs)
 
         return update_wrapper(new_func, func)
@@ -261,6 +959,82 @@ def pass_since_id_from(option_name: str) -> T.Callable:
     return wrapper
 
 
+def store_obj(name: str) -> T.Callable:
+    """Return an option callback storing the value in the context object."""
+
+    def callback(ctx: click.Context, param: click.Parameter, value):
+        ctx.obj[name] = value
+        return value
+
+    return callback
+
+
+media_option = click.option(
+    "--media",
+    is_flag=True,
+    expose_value=False,
+    callback=store_obj("download_media"),
+    help="Download attached photos and videos.",
+)
+
+
+def media_session_from(ctx: click.Context) -> requests.Session:
+    # Closing a session closes its adapters, so one session with the
+    # shared transport mounted lives as long as the context object
+    if "media_session" not in ctx.obj:
+        ctx.obj["media_session"] = ctx.obj["transport"].mount_to(requests.Session())
+    return ctx.obj["media_session"]
+
+
+def media_cache_from(ctx: click.Context) -> MediaCache:
+    # Kept in the context object to be reused across shell commands
+    if "media_cache" not in ctx.obj:
+        ctx.obj["media_cache"] = MediaCache(
+            os.path.join(ctx.obj["config_dir"], "media")
+        )
+    return ctx.obj["media_cache"]
+
+
+def status_cache_from(ctx: click.Context) -> StatusCache:
+    if "status_cache" not in ctx.obj:
+        # Statuses visible to one account may be protected from another
+        config = ctx.obj["config"]
+        account = ctx.obj["account"] or config.get("current_account")
+        ctx.obj["status_cache"] = StatusCache(
+            os.path.join(ctx.obj["config_dir"], f"statuses-{account}.json")
+        )
+    return ctx.obj["status_cache"]
+
+
+def download_tweets_media(ctx: click.Context, tweets: T.List[twitter.Status]) -> None:
+    if not ctx.obj.get("download_media"):
+        return
+    urls = [url for tweet in tweets for url in get_media_urls(tweet)]
+    results = download_media(media_cache_from(ctx), urls, media_session_from(ctx))
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            click.echo(f"Failed to download {url}: {result}", err=True)
+    count = sum(1 for result in results if not isinstance(result, Exception))
+    click.echo(f"Downloaded {count} media files", err=True)
+
+
+def tweet_filter_from(ctx: click.Context) -> TweetFilter:
+    if "tweet_filter" not in ctx.obj:
+        config = ctx.obj["config"]
+        account = ctx.obj["account"] or config.get("current_account")
+        ctx.obj["tweet_filter"] = TweetFilter.from_config(config, account)
+    return ctx.obj["tweet_filter"]
+
+
+def filtered(handler: T.Callable) -> T.Callable:
+    """Wrap a results handler to receive tweets not muted only."""
+
+    def filtered_handler(ctx: click.Context, tweets: T.List[twitter.Status]):
+        return handler(ctx, list(tweet_filter_from(ctx).filter(tweets)))
+
+    return filtered_handler
+
+
 _text_formatter = DefaultFormatter()
 
 
@@ -368,19 +1142,55 @@ def print_tweet(ctx: click.Context, tweet: T.Optional[twitter.Status]) -> None:
         click.echo(format_tweet_as_text(tweet))
 
 
+def _format_tweets_as_text(
+    tweets: T.List[T.Union[dict, twitter.Status]],
+) -> T.List[str]:
+    return [
+        format_tweet_as_text(
+            tweet
+            if isinstance(tweet, twitter.Status)
+            else twitter.Status.NewFromJsonDict(tweet)
+        )
+        for tweet in tweets
+    ]
+
+
+def iter_tweets_as_text(
+    tweets: T.List[twitter.Status],
+    jobs: int = 1,
+    threshold: int = PARALLEL_RENDER_THRESHOLD,
+) -> T.Iterator[str]:
+    """Yield tweets formatted as text in order. With more than one job
+    and enough tweets, chunks of tweets are formatted in a process pool."""
+    if jobs <= 1 or len(tweets) < threshold:
+        yield from map(format_tweet_as_text, tweets)
+        return
+
+    # Pickling raw JSON dicts is much cheaper than pickling statuses
+    raw_tweets = [getattr(tweet, "_json", None) or tweet for tweet in tweets]
+    # Several chunks per process to balance the load
+    chunk_size = -(-len(tweets) // (jobs * 4))
+    chunks = [raw_tweets[i : i + chunk_size] for i in range(0, len(tweets), chunk_size)]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for texts in executor.map(_format_tweets_as_text, chunks):
+            yield from texts
+
+
 def print_tweets(ctx: click.Context, tweets: T.List[twitter.Status]) -> None:
     format = ctx.obj["format"]
     if format == "json":
         output = "\n".join([format_tweet_as_json(tweet) for tweet in tweets])
         click.echo(output)
     elif format == "text":
-        output = "\n".join([format_tweet_as_text(tweet) for tweet in tweets])
+        texts = iter_tweets_as_text(tweets, jobs=ctx.obj["jobs"])
         if not tweets:
             pass
         elif len(tweets) == 1:
-            click.echo(output)
+            click.echo(next(texts))
         else:
-            click.echo_via_pager(output)
+            click.echo_via_pager(
+                text if n == 0 else "\n" + text for n, text in enumerate(texts)
+            )
 
 
 FORMAT_USER = """\t{_username_} @{screen_name}
@@ -449,16 +1259,23 @@ FORMAT_MESSAGE = """\t{_sender_screen_name_}
 """
 
 
+def message_screen_name(message: twitter.DirectMessage, role: str) -> T.Optional[str]:
+    """Return the screen name of the sender or recipient of a message
+    from its raw JSON, which DirectMessage does not keep."""
+    data = getattr(message, "_json", None) or {}
+    return data.get(f"{role}_screen_name") or (data.get(role) or {}).get("screen_name")
+
+
 def format_message_as_text(message: twitter.DirectMessage) -> str:
+    original = message
     message = message.AsDict()
     assert not any(key[0] == "_" and key[-1] == "_" for key in message.keys())
 
     created_at = parse_time(message["created_at"])
     message["_time_ago_"] = click.style(time_ago(created_at), fg="red")
 
-    message["_sender_screen_name_"] = click.style(
-        f" {message['sender_screen_name'] } ", fg="white", bg="black"
-    )
+    sender = message_screen_name(original, "sender") or message.get("sender_id")
+    message["_sender_screen_name_"] = click.style(f" {sender} ", fg="white", bg="black")
 
     message["_aligned_text_"] = align_text(
         message["text"], margin="\t", skip_first_line=True
@@ -474,7 +1291,7 @@ def format_message_as_json(message: twitter.DirectMessage) -> str:
 def print_message(ctx: click.Context, message: twitter.DirectMessage) -> None:
     if not message:
         return
-    format == ctx.obj["format"]
+    format = ctx.obj["format"]
     if format == "text":
         click.echo(format_message_as_text(message))
     elif format == "json":
@@ -492,10 +1309,67 @@ def print_messages(ctx: click.Context, messages: T.List[twitter.DirectMessage])
         else:
             click.echo_via_pager(output)
     elif format == "json":
-        output = "\n".join([format_user_as_json(message) for message in messages])
+        output = "\n".join([format_message_as_json(message) for message in messages])
         click.echo(output)
 
 
+def call_concurrently(
+    api: twitter.Api,
+    name: str,
+    kwargs_list: T.Iterable[dict],
+    max_workers: int = MAX_WORKERS,
+) -> T.List[T.Any]:
+    """Call the API method once per keyword arguments in a thread pool
+    sharing the pooled HTTP session of the API, and return results in
+    the same order. Failed calls return their errors instead, so one
+    failure does not lose the other results."""
+    method = getattr(api, name)
+
+    def call(kwargs: dict) -> T.Any:
+        try:
+            return method(**kwargs)
+        except (twitter.error.TwitterError, requests.RequestException) as err:
+            return err
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(call, kwargs_list))
+
+
+def report_failures(labels: T.Iterable[str], results: T.List[T.Any]) -> T.List[T.Any]:
+    """Report failed results of call_concurrently by label, and return
+    the successful ones."""
+    successes = []
+    for label, result in zip(labels, results):
+        if isinstance(result, Exception):
+            click.echo(f"Failed {label}: {result}", err=True)
+        else:
+            successes.append(result)
+    return successes
+
+
+def lookup_users(
+    api: twitter.Api, user_ids: T.List[int], max_workers: int = MAX_WORKERS
+) -> T.List[twitter.User]:
+    """Look up users by ids in concurrent batches, in the order of ids.
+    Failed batches are reported, and the users of the others returned."""
+    starts = range(0, len(user_ids), MAX_LOOKUP_COUNT)
+    results = call_concurrently(
+        api,
+        "UsersLookup",
+        [{"user_id": user_ids[start : start + MAX_LOOKUP_COUNT]} for start in starts],
+        max_workers=max_workers,
+    )
+    batches = report_failures(
+        [
+            f"to look up users {start + 1}-{min(start + MAX_LOOKUP_COUNT, len(user_ids))}"
+            for start in starts
+        ],
+        results,
+    )
+    users = {user.id: user for batch in batches for user in batch}
+    return [users[user_id] for user_id in user_ids if user_id in users]
+
+
 def read_text(words: T.List[str]) -> str:
     if len(words) == 1 and words[0] == "-":
         text = click.get_text_stream("stdin").read()
@@ -564,41 +1438,197 @@ def pop(api: twitter.Api, drop: bool) -> twitter.Status:
 
 @ptwit.command()
 @click.option("--count", "-c", default=MAX_COUNT, type=click.INT)
+@media_option
 @click.argument("users", nargs=-1)
-@handle_results(print_tweets)
-@pass_obj_args("api")
+@handle_results(print_tweets, download_tweets_media)
+@pass_obj_args("api", "max_concurrency")
 def tweets(
-    api: twitter.Api, users: T.List[str], count: int = None
+    api: twitter.Api, max_concurrency: int, users: T.List[str], count: int = None
 ) -> T.List[twitter.Status]:
     """List user's tweets."""
     if not users:
         users = [api.VerifyCredentials().screen_name]
 
-    tweets = []
-    for user in users:
-        tweets += api.GetUserTimeline(screen_name=user, count=count)
-    return tweets
+    results = call_concurrently(
+        api,
+        "GetUserTimeline",
+        [{"screen_name": user, "count": count} for user in users],
+        max_workers=max_concurrency,
+    )
+    timelines = report_failures([f"to get tweets of {user}" for user in users], results)
+    return [tweet for timeline in timelines for tweet in timeline]
+
+
+def is_snapshot_enabled(ctx: click.Context) -> bool:
+    config = ctx.obj["config"]
+    account = ctx.obj["account"]
+    value = config.get("timeline_snapshot", account=account) or config.get(
+        "timeline_snapshot"
+    )
+    return bool(account) and str(value).lower() in ("1", "yes", "true", "on")
+
+
+def timeline_snapshot_path(ctx: click.Context) -> str:
+    return os.path.join(ctx.obj["config_dir"], f"timeline-{ctx.obj['account']}.json")
+
+
+def read_snapshot(filename: str) -> T.Optional[T.List[twitter.Status]]:
+    try:
+        with open(filename) as fp:
+            return [twitter.Status.NewFromJsonDict(data) for data in json.load(fp)]
+    except (IOError, ValueError):
+        return None
+
+
+def write_snapshot(filename: str, tweets: T.List[twitter.Status]) -> None:
+    with open(filename + ".tmp", "w") as fp:
+        json.dump([tweet._json for tweet in tweets], fp, ensure_ascii=False)
+    os.replace(filename + ".tmp", filename)
+
+
+@contextmanager
+def exclusive_lock(filename: str) -> T.Iterator[bool]:
+    """Create a lock file exclusively, and yield whether it is acquired."""
+    try:
+        if STALE_LOCK_AGE < time.time() - os.path.getmtime(filename):
+            os.remove(filename)
+    except OSError:
+        pass
+
+    try:
+        fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        yield False
+        return
+
+    try:
+        os.close(fd)
+        yield True
+    finally:
+        os.remove(filename)
+
+
+def spawn_detached(args: T.List[str]) -> None:
+    """Run ptwit with args in a detached background process."""
+    kwargs: T.Dict[str, T.Any] = {}
+    if sys.platform == "win32":
+        kwargs["creationflags"] = (
+            subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        )
+    else:
+        kwargs["start_new_session"] = True
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__)] + args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        close_fds=True,
+        **kwargs,
+    )
 
 
 @ptwit.command()
 @click.option("--count", "-c", type=click.INT)
-@handle_results(print_tweets, save_since_id_at("timeline_since_id"))
+@click.option(
+    "--fresh", is_flag=True, help="Fetch now instead of showing the snapshot."
+)
+@media_option
+@handle_results(
+    filtered(print_tweets),
+    filtered(download_tweets_media),
+    update_stats_at("timeline", "timeline_since_id"),
+    save_since_id_at("timeline_since_id"),
+)
 @pass_since_id_from("timeline_since_id")
-@pass_obj_args("api")
+@click.pass_context
 def timeline(
-    api: twitter.Api, count: int = None, since_id: int = None
+    ctx: click.Context, count: int = None, since_id: int = None, fresh: bool = False
 ) -> T.List[twitter.Status]:
-    """List timeline."""
+    """List timeline.
+
+    With timeline_snapshot enabled in the config, show the tweets
+    fetched by background refreshes that are not shown yet, and start
+    a new refresh.
+    """
+    snapshot_enabled = is_snapshot_enabled(ctx)
+    filename = timeline_snapshot_path(ctx)
+    if snapshot_enabled and count is None and not fresh:
+        snapshot = read_snapshot(filename)
+        if snapshot is not None:
+            spawn_detached(["--account", ctx.obj["account"], "refresh-timeline"])
+            tweets = unshown_tweets(ctx, snapshot)
+            save_since_id_at("timeline_shown_id")(ctx, tweets)
+            return tweets
+
     if count is None:
         count = MAX_COUNT
     else:
         since_id = None
-    return api.GetHomeTimeline(count=count, since_id=since_id)
+    tweets = api_from(ctx).GetHomeTimeline(count=count, since_id=since_id)
+    if snapshot_enabled:
+        # Never show these again from a snapshot, e.g. one written by
+        # a refresh running meanwhile
+        save_since_id_at("timeline_shown_id")(ctx, tweets)
+        if read_snapshot(filename) is None:
+            with exclusive_lock(filename + ".lock") as acquired:
+                if acquired:
+                    write_snapshot(filename, [])
+    return tweets
+
+
+def unshown_tweets(
+    ctx: click.Context, tweets: T.List[twitter.Status]
+) -> T.List[twitter.Status]:
+    """Return tweets newer than the last one shown from the timeline."""
+    state = ctx.obj["state"]
+    shown_id = int(
+        state.get("timeline_shown_id", account=ctx.obj["account"], default=0)
+    )
+    return [tweet for tweet in tweets if shown_id < tweet.id]
+
+
+@ptwit.command("refresh-timeline", hidden=True)
+@click.pass_context
+def refresh_timeline(ctx: click.Context) -> None:
+    """Fetch new timeline tweets into the snapshot."""
+    filename = timeline_snapshot_path(ctx)
+    with exclusive_lock(filename + ".lock") as acquired:
+        if not acquired:
+            return
+        account = ctx.obj["account"]
+        # Use stored credentials only: never prompt, verify or save
+        # the config in the background
+        api = stored_api(ctx.obj["config"], account, adapter=ctx.obj["transport"])
+        if api is None:
+            return
+        since_id = ctx.obj["state"].get("timeline_since_id", account=account)
+        tweets = api.GetHomeTimeline(count=MAX_COUNT, since_id=since_id)
+        # Add to the tweets not shown yet, keeping the newest ones
+        fetched_ids = {tweet.id for tweet in tweets}
+        snapshot = sorted(
+            tweets
+            + [
+                tweet
+                for tweet in unshown_tweets(ctx, read_snapshot(filename) or [])
+                if tweet.id not in fetched_ids
+            ],
+            key=lambda tweet: tweet.id,
+            reverse=True,
+        )[:MAX_COUNT]
+        # Save the mark only once the tweets are safely in the
+        # snapshot, or they would never be shown
+        write_snapshot(filename, snapshot)
+        update_stats_at("timeline", "timeline_since_id")(ctx, tweets)
+        save_since_id_at("timeline_since_id")(ctx, tweets)
 
 
 @ptwit.command()
 @click.option("--count", "-c", type=click.INT)
-@handle_results(print_tweets, save_since_id_at("mentions_since_id"))
+@handle_results(
+    filtered(print_tweets),
+    update_stats_at("mentions", "mentions_since_id"),
+    save_since_id_at("mentions_since_id"),
+)
 @pass_since_id_from("mentions_since_id")
 @pass_obj_args("api")
 def mentions(api: twitter.Api, count=None, since_id=None) -> T.List[twitter.Status]:
@@ -612,7 +1642,7 @@ def mentions(api: twitter.Api, count=None, since_id=None) -> T.List[twitter.Stat
 
 @ptwit.command()
 @click.option("--count", "-c", type=click.INT)
-@handle_results(print_tweets, save_since_id_at("replies_since_id"))
+@handle_results(filtered(print_tweets), save_since_id_at("replies_since_id"))
 @pass_since_id_from("replies_since_id")
 @pass_obj_args("api")
 def replies(
@@ -626,20 +1656,91 @@ def replies(
     return api.GetReplies(count=count, since_id=since_id)
 
 
+def iter_message_pages(
+    fetch: T.Callable, since_id: T.Optional[int] = None
+) -> T.Iterator[T.List[twitter.DirectMessage]]:
+    """Page backwards through messages newer than since_id, using
+    max_id as the cursor."""
+    max_id = None
+    while True:
+        page = fetch(count=MAX_COUNT, since_id=since_id, max_id=max_id)
+        if not page:
+            break
+        yield page
+        max_id = min(message.id for message in page) - 1
+
+
+def sync_messages(
+    api: twitter.Api, state: TwitterState, account: str
+) -> T.List[twitter.DirectMessage]:
+    """Store received and sent messages newer than the last sync,
+    indexed by conversation partner, and return new received
+    messages, newest first.
+
+    Each page is stored as soon as it is fetched, but the since_id only
+    moves once paging completes, so an interrupted sync resumes from
+    the last complete one and the stored pages are fetched again."""
+    received = []
+    for option_name, fetch, partner_role in (
+        ("messages_since_id", api.GetDirectMessages, "sender"),
+        ("sent_messages_since_id", api.GetSentDirectMessages, "recipient"),
+    ):
+        since_id = state.get(option_name, account=account)
+        last_id = None
+        for page in iter_message_pages(fetch, since_id=since_id):
+            state.add_messages(
+                [
+                    (
+                        message.id,
+                        message_screen_name(message, partner_role)
+                        or str(getattr(message, f"{partner_role}_id")),
+                        getattr(message, "_json", None) or message.AsDict(),
+                    )
+                    for message in page
+                ],
+                account=account,
+            )
+            last_id = max([last_id or 0] + [message.id for message in page])
+            if partner_role == "sender":
+                received.extend(page)
+        if last_id is not None:
+            state.set(option_name, last_id, account=account)
+    return sorted(received, key=lambda message: message.id, reverse=True)
+
+
 @ptwit.command()
-@click.option("--count", "-c", default=MAX_COUNT, type=click.INT)
-@handle_results(print_messages, save_since_id_at("messages_since_id"))
-@pass_since_id_from("messages_since_id")
-@pass_obj_args("api")
+@click.option(
+    "--count",
+    "-c",
+    type=click.INT,
+    help="Show at most this many, newest first. Hidden new messages are "
+    "still marked as seen.",
+)
+@click.argument("user", required=False)
+@handle_results(print_messages)
+@click.pass_context
 def messages(
-    api: twitter.Api, count: int = None, since_id: int = None
+    ctx: click.Context, user: T.Optional[str], count: T.Optional[int]
 ) -> T.List[twitter.DirectMessage]:
-    """List messages."""
-    if count is None:
-        count = MAX_COUNT
-    else:
-        since_id = None
-    return api.GetDirectMessages(count=count, since_id=since_id)
+    """List new messages, or the conversation with a user.
+
+    New messages are synced into a local store first; a conversation
+    is read from the store without fetching. The count limits what is
+    shown only: all new messages are synced and marked as seen.
+    """
+    config = ctx.obj["config"]
+    state = ctx.obj["state"]
+    account = ctx.obj["account"] or config.get("current_account")
+    if user:
+        conversation = state.get_messages(user, account=account, limit=count)
+        return [
+            twitter.DirectMessage.NewFromJsonDict(data)
+            for data in reversed(conversation)
+        ]
+    api = api_from(ctx)
+    # Logging in may have chosen the account
+    account = ctx.obj["account"] or config.get("current_account")
+    return sync_messages(api, state, account)[:count]
 
 
 @ptwit.command()
@@ -657,37 +1758,285 @@ def send(api: twitter.Api, user: str, words: T.List[str]):
 @ptwit.command()
 @click.argument("user")
 @handle_results(print_users)
-@pass_obj_args("api")
-def followings(api: twitter.Api, user: str) -> T.List[twitter.User]:
+@pass_obj_args("api", "max_concurrency")
+def followings(
+    api: twitter.Api, max_concurrency: int, user: str
+) -> T.List[twitter.User]:
     """List who you are following."""
-    return api.GetFriends(user)
+    return lookup_users(api, api.GetFriendIDs(screen_name=user), max_concurrency)
 
 
 @ptwit.command()
 @click.argument("user")
 @handle_results(print_users)
-@pass_obj_args("api")
-def followers(api: twitter.Api, user: str) -> T.List[twitter.User]:
+@pass_obj_args("api", "max_concurrency")
+def followers(
+    api: twitter.Api, max_concurrency: int, user: str
+) -> T.List[twitter.User]:
     """List your followers."""
-    return api.GetFollowers(user)
+    return lookup_users(api, api.GetFollowerIDs(screen_name=user), max_concurrency)
 
 
 @ptwit.command()
 @click.argument("users", nargs=-1)
 @handle_results(print_users)
-@pass_obj_args("api")
-def follow(api: twitter.Api, users: T.List[str]):
+@pass_obj_args("api", "max_concurrency")
+def follow(api: twitter.Api, max_concurrency: int, users: T.List[str]):
     """Follow users."""
-    return [api.CreateFriendship(screen_name=user) for user in users]
+    results = call_concurrently(
+        api,
+        "CreateFriendship",
+        [{"screen_name": user} for user in users],
+        max_workers=max_concurrency,
+    )
+    return report_failures([f"to follow {user}" for user in users], results)
 
 
 @ptwit.command()
 @click.argument("users", nargs=-1, required=True)
 @handle_results(print_users)
-@pass_obj_args("api")
-def unfollow(api: twitter.Api, users: T.List[str]):
+@pass_obj_args("api", "max_concurrency")
+def unfollow(api: twitter.Api, max_concurrency: int, users: T.List[str]):
     """Unfollow users."""
-    return [api.DestroyFriendship(screen_name=user) for user in users]
+    results = call_concurrently(
+        api,
+        "DestroyFriendship",
+        [{"screen_name": user} for user in users],
+        max_workers=max_concurrency,
+    )
+    return report_failures([f"to unfollow {user}" for user in users], results)
+
+
+def is_connect_error(err: Exception) -> bool:
+    """Whether the request failed before it was sent."""
+    if isinstance(err, requests.ConnectTimeout):
+        return True
+    if isinstance(err, requests.ConnectionError) and err.args:
+        reason = getattr(err.args[0], "reason", None)
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
+
+
+def is_transient_error(err: Exception, idempotent: bool = True) -> bool:
+    """Whether retrying may succeed. Non-idempotent requests are
+    retried only if they were never sent, to avoid duplicates."""
+    if is_connect_error(err):
+        return True
+    if not idempotent:
+        return False
+    if isinstance(err, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(err, twitter.error.TwitterError):
+        errors = err.message if isinstance(err.message, list) else [err.message]
+        for error in errors:
+            if not isinstance(error, dict):
+                continue
+            if error.get("code") in TRANSIENT_ERROR_CODES:
+                return True
+            if error.get("message") in TRANSIENT_ERROR_MESSAGES:
+                return True
+    return False
+
+
+def retry_transient(
+    func: T.Callable,
+    idempotent: bool = True,
+    max_retries: int = MAX_RETRIES,
+    backoff: float = 1.0,
+) -> T.Any:
+    """Call func, retrying transient errors with jittered exponential backoff."""
+    for trial in range(max_retries + 1):
+        try:
+            return func()
+        except Exception as err:
+            if max_retries <= trial or not is_transient_error(err, idempotent):
+                raise
+            time.sleep(backoff * 2**trial * random.uniform(0.5, 1.5))
+
+
+class Pacer:
+    """Space out calls evenly at a rate (calls per second), across threads."""
+
+    interval: float
+    next_time: float
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            start_time = max(self.next_time, now)
+            self.next_time = start_time + self.interval
+        time.sleep(start_time - now)
+
+
+BATCH_OPERATIONS: T.Dict[str, T.Callable[[twitter.Api, dict], T.Any]] = {
+    "post": lambda api, item: api.PostUpdate(item["text"]),
+    "send": lambda api, item: api.PostDirectMessage(
+        item["text"], screen_name=item["user"]
+    ),
+    "follow": lambda api, item: api.CreateFriendship(screen_name=item["user"]),
+    "unfollow": lambda api, item: api.DestroyFriendship(screen_name=item["user"]),
+}
+
+
+def read_batch_items(
+    fp: T.IO, is_csv: bool = False
+) -> T.Iterator[T.Union[dict, ValueError]]:
+    """Read batch operations from NDJSON lines, or CSV rows with
+    headers (e.g. op,user,text). A line of invalid JSON is yielded as
+    its error, so it fails at its own index instead of aborting the
+    batch."""
+    if is_csv:
+        yield from csv.DictReader(fp)
+    else:
+        for line in fp:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as err:
+                    yield err
+
+
+def read_batch_done(fp: T.IO) -> T.Set[int]:
+    """Read indices of succeeded items from a batch result log."""
+    done = set()
+    for line in fp:
+        if line.strip():
+            result = json.loads(line)
+            if result.get("status") == "ok":
+                done.add(result["index"])
+    return done
+
+
+def run_batch_item(api: twitter.Api, pacer: Pacer, index: int, item: T.Any) -> dict:
+    if isinstance(item, ValueError):
+        return {"index": index, "status": "error", "error": f"Invalid JSON: {item}"}
+    if not isinstance(item, dict):
+        return {"index": index, "status": "error", "error": "Expected an object"}
+
+    op = str(item.get("op"))
+    result = {"index": index, "op": op}
+    operation = BATCH_OPERATIONS.get(op)
+    if operation is None:
+        result.update(status="error", error=f"Unknown operation {op!r}")
+        return result
+
+    def call():
+        pacer.wait()
+        return operation(api, item)
+
+    try:
+        # All batch operations are writes
+        returned = retry_transient(call, idempotent=False)
+    except Exception as err:
+        # Any error fails this item only, e.g. a missing "text" key
+        result.update(status="error", error=str(err) or repr(err))
+    else:
+        result.update(status="ok", id=returned.id)
+    return result
+
+
+def run_batch(
+    api: twitter.Api,
+    items: T.Iterable[T.Any],
+    rate: float,
+    record: T.Callable[[dict], None],
+    done: T.Optional[T.Set[int]] = None,
+    max_workers: int = MAX_WORKERS,
+) -> None:
+    """Run batch operations concurrently, paced at rate (operations per
+    second), and record results as they finish. Items whose indices
+    are in done are skipped.
+
+    Only a few operations are submitted ahead. If anything raises,
+    e.g. record or a keyboard interrupt, the operations not started
+    are cancelled, and the running ones are still waited for and
+    recorded, so the log covers everything that has run.
+    """
+    done = done or set()
+    pacer = Pacer(rate)
+    todo = ((index, item) for index, item in enumerate(items) if index not in done)
+    pending: T.Set[Future] = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for index, item in todo:
+                pending.add(executor.submit(run_batch_item, api, pacer, index, item))
+                if len(pending) < max_workers * 2:
+                    continue
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record(future.result())
+            for future in as_completed(pending):
+                pending.discard(future)
+                record(future.result())
+        finally:
+            running = [future for future in pending if not future.cancel()]
+            for future in as_completed(running):
+                record(future.result())
+
+
+@ptwit.command()
+@click.argument("input", type=click.File("r"), default="-")
+@click.option("--csv", "is_csv", is_flag=True, help="Read input as CSV.")
+@click.option(
+    "--log",
+    type=click.Path(dir_okay=False),
+    help="Append results to this file, and skip items succeeded in it.",
+)
+@click.option("--rate", default=1.0, type=click.FLOAT, help="Operations per second.")
+@pass_obj_args("api", "max_concurrency")
+def batch(
+    api: twitter.Api,
+    max_concurrency: int,
+    input: T.IO,
+    is_csv: bool,
+    log: T.Optional[str],
+    rate: float,
+) -> None:
+    """Post, send, follow or unfollow in bulk.
+
+    Read operations from INPUT (stdin by default) as NDJSON objects
+    like {"op": "follow", "user": "...", "text": "..."}, or CSV rows
+    with op,user,text headers.
+    """
+    done: T.Set[int] = set()
+    if log and os.path.isfile(log):
+        with open(log) as fp:
+            done = read_batch_done(fp)
+
+    items = read_batch_items(input, is_csv=is_csv)
+    log_file = open(log, "a") if log else None
+    log_fp: T.IO = log_file or sys.stdout
+    results: T.List[dict] = []
+
+    def record(result: dict) -> None:
+        nonlocal log_fp
+        results.append(result)
+        line = json.dumps(result, ensure_ascii=False)
+        try:
+            log_fp.write(line + "\n")
+            log_fp.flush()
+        except OSError as err:
+            # Stop the batch, but keep recording results of operations
+            # already running where they can still be seen
+            log_fp = sys.stderr
+            log_fp.write(line + "\n")
+            raise click.ClickException(f"Failed to write the log: {err}")
+
+    try:
+        run_batch(api, items, rate, record, done=done, max_workers=max_concurrency)
+    finally:
+        if log_file:
+            log_file.close()
+
+    failed = sum(1 for result in results if result["status"] != "ok")
+    if failed:
+        click.echo(f"{failed} operations failed", err=True)
+        sys.exit(1)
 
 
 @ptwit.command()
@@ -699,29 +2048,312 @@ def faves(api: twitter.Api, user: str):
     return api.GetFavorites(screen_name=user)
 
 
+def iter_search_pages(
+    api: twitter.Api, query: str, count: int
+) -> T.Iterator[T.List[twitter.Status]]:
+    """Page through search results of a query backwards with max_id,
+    until count tweets are fetched or no more results."""
+    max_id = None
+    while 0 < count:
+        page = api.GetSearch(
+            term=query,
+            count=min(count, MAX_SEARCH_COUNT),
+            max_id=max_id,
+            result_type="recent",
+        )
+        if not page:
+            break
+        page = sorted(page, key=lambda tweet: tweet.id, reverse=True)
+        yield page
+        count -= len(page)
+        max_id = page[-1].id - 1
+
+
+def _put_search_pages(
+    api: twitter.Api,
+    query: str,
+    count: int,
+    pages: queue.Queue,
+    stopped: threading.Event,
+) -> None:
+    try:
+        for page in iter_search_pages(api, query, count):
+            if stopped.is_set():
+                break
+            pages.put(page)
+    except Exception as err:
+        pages.put(err)
+    else:
+        pages.put(None)
+
+
+def _iter_queued_pages(
+    pages: queue.Queue, query: str, failures: T.Dict[str, Exception]
+) -> T.Iterator[T.Tuple[twitter.Status, str]]:
+    while True:
+        page = pages.get()
+        if page is None:
+            return
+        if isinstance(page, Exception):
+            failures[query] = page
+            return
+        for tweet in page:
+            yield tweet, query
+
+
+def search_tweets(
+    api: twitter.Api,
+    queries: T.List[str],
+    count: int,
+    max_workers: int = MAX_WORKERS,
+    failures: T.Optional[T.Dict[str, Exception]] = None,
+) -> T.Iterator[T.Tuple[twitter.Status, T.List[str]]]:
+    """Search queries concurrently, and yield tweets merged newest-first
+    and deduplicated by id as they arrive, each with the queries that
+    found it.
+
+    A failed query ends with the tweets found so far, and its error is
+    stored in failures by query. Closing the generator stops paging.
+    """
+    if failures is None:
+        failures = {}
+    queues: T.List[queue.Queue] = [queue.Queue() for _ in queries]
+    stopped = threading.Event()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for query, pages in zip(queries, queues):
+                executor.submit(_put_search_pages, api, query, count, pages, stopped)
+            merged = heapq.merge(
+                *[
+                    _iter_queued_pages(pages, query, failures)
+                    for query, pages in zip(queries, queues)
+                ],
+                key=lambda pair: pair[0].id,
+                reverse=True,
+            )
+            # Duplicates are adjacent, as tweets are merged by id
+            for _, group in groupby(merged, key=lambda pair: pair[0].id):
+                pairs = list(group)
+                yield pairs[0][0], [query for _, query in pairs]
+        finally:
+            stopped.set()
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def update_search_stats(ctx: click.Context, results: T.List[twitter.Status]) -> None:
+    """Add tweets to the search stats if newer than the since id mark
+    of any query that found them. Each query keeps its own mark, so
+    adding or removing a query does not count other queries' tweets
+    again. It must run before the marks are saved."""
+    if not results:
+        return
+    config = ctx.obj["config"]
+    state = ctx.obj["state"]
+    account = ctx.obj["account"] or config.get("current_account")
+    queries_of = ctx.obj["search_queries_of"]
+    since_ids = {
+        query: int(state.get(f"search_since_id:{query}", account=account, default=0))
+        for query in set(chain.from_iterable(queries_of.values()))
+    }
+    new_tweets = [
+        tweet
+        for tweet in results
+        if any(since_ids[query] < tweet.id for query in queries_of[tweet.id])
+    ]
+    state.add_stats("search", count_tweets(new_tweets), account=account)
+
+
+def save_search_since_ids(ctx: click.Context, results: T.List[twitter.Status]) -> None:
+    config = ctx.obj["config"]
+    state = ctx.obj["state"]
+    account = ctx.obj["account"] or config.get("current_account")
+    queries_of = ctx.obj["search_queries_of"]
+    newest: T.Dict[str, int] = {}
+    for tweet in results:
+        for query in queries_of[tweet.id]:
+            newest[query] = max(newest.get(query, 0), tweet.id)
+    for query, tweet_id in newest.items():
+        option_name = f"search_since_id:{query}"
+        since_id = state.get(option_name, account=account)
+        if since_id is None or int(since_id) < tweet_id:
+            state.set(option_name, tweet_id, account=account)
+
+
 @ptwit.command()
-@click.option("--count", "-c", default=MAX_COUNT)
+@click.option(
+    "--count", "-c", default=MAX_COUNT, help="Maximum number of tweets per query."
+)
+@click.option("--query", "-q", "queries", multiple=True, help="Add a search query.")
 @click.argument("term", nargs=-1)
-@handle_results(print_tweets)
-@pass_obj_args("api")
-def search(api: twitter.Api, count: int, term: T.List[str]) -> T.List[twitter.Status]:
+@handle_results(
+    filtered(print_tweets),
+    update_search_stats,
+    save_search_since_ids,
+)
+@click.pass_context
+def search(
+    ctx: click.Context, count: int, queries: T.List[str], term: T.List[str]
+) -> T.List[twitter.Status]:
     """Search Twitter."""
+    queries = list(queries)
     if term:
-        query = " ".join(term).encode("utf-8")
-    else:
-        query = click.prompt("Search")
-    return api.GetSearch(term=query, count=count)
+        queries.append(" ".join(term))
+    if not queries:
+        queries.append(click.prompt("Search"))
+    tweets = []
+    queries_of = ctx.obj["search_queries_of"] = {}
+    failures: T.Dict[str, Exception] = {}
+    for tweet, tweet_queries in search_tweets(
+        ctx.obj["api"],
+        queries,
+        count,
+        max_workers=ctx.obj["max_concurrency"],
+        failures=failures,
+    ):
+        tweets.append(tweet)
+        queries_of[tweet.id] = [normalize_query(query) for query in tweet_queries]
+    report_failures(
+        [f"to search {query}" for query in queries],
+        [failures.get(query, query) for query in queries],
+    )
+    return tweets
 
 
 @ptwit.command()
 @click.argument("users", nargs=-1)
 @handle_results(print_users)
-@pass_obj_args("api")
-def whois(api: twitter.Api, users: T.List[str]) -> T.List[twitter.User]:
+@pass_obj_args("api", "max_concurrency")
+def whois(
+    api: twitter.Api, max_concurrency: int, users: T.List[str]
+) -> T.List[twitter.User]:
     """Show user profiles."""
     if not users:
         return [api.VerifyCredentials()]
-    return [api.GetUser(screen_name=screen_name) for screen_name in users]
+    results = call_concurrently(
+        api,
+        "GetUser",
+        [{"screen_name": user} for user in users],
+        max_workers=max_concurrency,
+    )
+    return report_failures([f"to get {user}" for user in users], results)
+
+
+def fetch_threads(
+    api: twitter.Api, cache: StatusCache, status_ids: T.List[int]
+) -> T.List[T.List[twitter.Status]]:
+    """Rebuild reply chains ending at the given statuses, oldest first.
+    Each hop of all chains is resolved with one bulk lookup."""
+    threads: T.Dict[int, T.List[twitter.Status]] = {
+        status_id: [] for status_id in status_ids
+    }
+    pending = {status_id: status_id for status_id in status_ids}
+    while pending:
+        statuses = cache.lookup(api, pending.values())
+        next_pending = {}
+        for thread_id, status_id in pending.items():
+            status = statuses[status_id]
+            if status is None:
+                continue
+            threads[thread_id].append(status)
+            if status.in_reply_to_status_id:
+                next_pending[thread_id] = status.in_reply_to_status_id
+        pending = next_pending
+    return [list(reversed(threads[status_id])) for status_id in status_ids]
+
+
+@ptwit.command()
+@click.argument("status_ids", nargs=-1, type=click.INT, required=True)
+@handle_results(print_tweets)
+@click.pass_context
+def thread(ctx: click.Context, status_ids: T.List[int]) -> T.List[twitter.Status]:
+    """Show conversations leading to tweets."""
+    cache = status_cache_from(ctx)
+    threads = fetch_threads(ctx.obj["api"], cache, list(status_ids))
+    cache.save()
+    return [status for statuses in threads for status in statuses]
+
+
+@ptwit.command()
+@click.argument("status_ids", nargs=-1, type=click.INT, required=True)
+@click.pass_context
+def media(ctx: click.Context, status_ids: T.List[int]) -> None:
+    """Download media attached to tweets."""
+    cache = status_cache_from(ctx)
+    statuses = cache.lookup(ctx.obj["api"], status_ids)
+    cache.save()
+    urls = [
+        url
+        for status_id in status_ids
+        if statuses[status_id]
+        for url in get_media_urls(statuses[status_id])
+    ]
+    results = download_media(media_cache_from(ctx), urls, media_session_from(ctx))
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            click.echo(f"Failed to download {url}: {result}", err=True)
+        else:
+            click.echo(result)
+
+
+STATS_SOURCES = ("timeline", "mentions", "search")
+STATS_KINDS = (
+    ("author", "Authors"),
+    ("hashtag", "Hashtags"),
+    ("mention", "Mentions"),
+)
+
+
+def print_stats(ctx: click.Context, stats: T.Dict[str, T.List[T.Tuple[str, int]]]):
+    format = ctx.obj["format"]
+    if format == "json":
+        click.echo(json.dumps({kind: dict(pairs) for kind, pairs in stats.items()}))
+    elif format == "text":
+        for kind, title in STATS_KINDS:
+            click.echo(click.style(f" {title} ", fg="white", bg="black"))
+            for key, count in stats[kind]:
+                click.echo(f"\t{count:>6}  {key}")
+            click.echo()
+
+        click.echo(click.style(" Hourly activity (UTC) ", fg="white", bg="black"))
+        hours = dict(stats["hour"])
+        peak = max(hours.values(), default=0)
+        for hour in range(24):
+            count = hours.get(f"{hour:02d}", 0)
+            bar = "#" * (40 * count // peak if peak else 0)
+            click.echo(f"\t{hour:02d}  {count:>6}  {bar}".rstrip())
+
+
+@ptwit.command()
+@click.option(
+    "--source",
+    "-s",
+    "sources",
+    multiple=True,
+    type=click.Choice(STATS_SOURCES),
+    help="Report on this source only (repeatable).",
+)
+@click.option("--top", "-n", default=10, help="Number of top entries to show.")
+@handle_results(print_stats)
+@pass_obj_args("state", "config", "account")
+def stats(
+    state: TwitterState,
+    config: TwitterConfig,
+    account: T.Optional[str],
+    sources: T.List[str],
+    top: int,
+) -> T.Dict[str, T.List[T.Tuple[str, int]]]:
+    """Show statistics of fetched tweets."""
+    account = account or config.get("current_account")
+    sources = list(sources) or list(STATS_SOURCES)
+    result = {
+        kind: state.get_stats(kind, account=account, sources=sources, limit=top)
+        for kind, _ in STATS_KINDS
+    }
+    result["hour"] = state.get_stats("hour", account=account, sources=sources)
+    return result
 
 
 def print_accounts(ctx: click.Context, accounts: T.List[str]) -> None:
@@ -744,14 +2376,83 @@ def accounts(ctx: click.Context) -> T.List[str]:
 
 @ptwit.command()
 @click.argument("account")
-@pass_obj_args("config")
-def login(config: TwitterConfig, account: str) -> None:
+@pass_obj_args("config", "transport")
+def login(config: TwitterConfig, transport: TransportAdapter, account: str) -> None:
     """Log into an account."""
-    _login(config, account)
+    _login(config, account, adapter=transport)
     current_account = config.get("current_account")
     click.echo(f'Switched to account "{current_account}"')
 
 
+SHELL_EXCLUDED_COMMANDS = ("shell", "login")
+
+
+def run_shell_line(ctx: click.Context, line: str) -> None:
+    """Run a command line within the group context, reusing its
+    context object (the API session and caches)."""
+    args = shlex.split(line)
+    if not args:
+        return
+    cmd_name, args = args[0], args[1:]
+    # Look up commands without falling back to the default command
+    cmd = click.Group.get_command(T.cast(click.Group, ctx.command), ctx, cmd_name)
+    if cmd is None:
+        raise click.UsageError(f'No such command "{cmd_name}"')
+    if cmd_name in SHELL_EXCLUDED_COMMANDS:
+        raise click.UsageError(f'"{cmd_name}" is not available in the shell')
+    with cmd.make_context(cmd_name, args, parent=ctx) as sub_ctx:
+        cmd.invoke(sub_ctx)
+
+
+def run_shell_line_reporting_errors(ctx: click.Context, line: str) -> None:
+    """Run a command line, reporting any error instead of leaving the
+    shell."""
+    try:
+        run_shell_line(ctx, line)
+    except click.ClickException as err:
+        err.show()
+    except (click.exceptions.Exit, SystemExit):
+        pass
+    except (click.Abort, KeyboardInterrupt):
+        click.echo("Aborted!", err=True)
+    except twitter.error.TwitterError as err:
+        click.echo(f"Twitter Error: {err}", err=True)
+    except requests.RequestException as err:
+        click.echo(f"Network Error: {err}", err=True)
+    except Exception as err:
+        # e.g. unbalanced quotes, or a bug in a command
+        click.echo(f"Error: {err}", err=True)
+
+
+@ptwit.command()
+@click.pass_context
+def shell(ctx: click.Context) -> None:
+    """Run commands interactively in one session."""
+    # Enable line editing and history for input() where available
+    try:
+        import readline  # noqa: F401
+    except ImportError:
+        pass
+
+    group_ctx = T.cast(click.Context, ctx.parent)
+    config = ctx.obj["config"]
+    account = ctx.obj["account"] or config.get("current_account")
+    while True:
+        try:
+            line = input(f"{account}> ")
+        except KeyboardInterrupt:
+            click.echo()
+            continue
+        except EOFError:
+            click.echo()
+            break
+
+        if line.strip() in ("exit", "quit"):
+            break
+
+        run_shell_line_reporting_errors(group_ctx, line)
+
+
 def choose_account_name(config: TwitterConfig, default: str) -> str:
     """Prompt for choosing config name."""
 
@@ -766,7 +2467,50 @@ def choose_account_name(config: TwitterConfig, default: str) -> str:
     return name
 
 
-def _login(config: TwitterConfig, account: str = None) -> twitter.Api:
+def new_api(
+    consumer_key: str,
+    consumer_secret: str,
+    token_key: str,
+    token_secret: str,
+    adapter: T.Optional[TransportAdapter] = None,
+) -> twitter.Api:
+    api = twitter.Api(
+        consumer_key=consumer_key,
+        consumer_secret=consumer_secret,
+        access_token_key=token_key,
+        access_token_secret=token_secret,
+    )
+    if adapter:
+        # twitter.Api has no public way to configure its session
+        adapter.mount_to(api._session)
+    return api
+
+
+def stored_api(
+    config: TwitterConfig,
+    account: str,
+    adapter: T.Optional[TransportAdapter] = None,
+) -> T.Optional[twitter.Api]:
+    """Return an API with the stored credentials of an account, or None
+    if the account is not logged in yet."""
+    consumer_key = config.get("consumer_key", account=account) or config.get(
+        "consumer_key"
+    )
+    consumer_secret = config.get("consumer_secret", account=account) or config.get(
+        "consumer_secret"
+    )
+    token_key = config.get("token_key", account=account)
+    token_secret = config.get("token_secret", account=account)
+    if not (consumer_key and consumer_secret and token_key and token_secret):
+        return None
+    return new_api(consumer_key, consumer_secret, token_key, token_secret, adapter)
+
+
+def _login(
+    config: TwitterConfig,
+    account: str = None,
+    adapter: T.Optional[TransportAdapter] = None,
+) -> twitter.Api:
     consumer_key = config.get("consumer_key", account=account) or config.get(
         "consumer_key"
     )
@@ -789,14 +2533,11 @@ def _login(config: TwitterConfig, account: str = None) -> twitter.Api:
             msg = "No account found."
         msg += " Open a web browser to authenticate?"
         click.confirm(msg, default=True, abort=True)
-        token_key, token_secret = fetch_access_token(consumer_key, consumer_secret)
+        token_key, token_secret = fetch_access_token(
+            consumer_key, consumer_secret, adapter=adapter
+        )
 
-    api = twitter.Api(
-        consumer_key=consumer_key,
-        consumer_secret=consumer_secret,
-        access_token_key=token_key,
-        access_token_secret=token_secret,
-    )
+    api = new_api(consumer_key, consumer_secret, token_key, token_secret, adapter)
 
     # We put it here to verify consumer pair and token pair
     user = api.VerifyCredentials()
@@ -825,7 +2566,10 @@ def _login(config: TwitterConfig, account: str = None) -> twitter.Api:
     # Update current account
     config.set("current_account", account)
 
-    config.save()
+    # Logging in with stored credentials changes nothing, so polling
+    # commands leave the config file untouched
+    if config.changed:
+        config.save()
 
     return api
 
@@ -839,6 +2583,9 @@ def cli() -> None:
     except TokenRequestDenied as err:
         click.echo(err, err=True)
         sys.exit(3)
+    except requests.RequestException as err:
+        click.echo(f"Network Error: {err}", err=True)
+        sys.exit(4)
 
 
 if __name__ == "__main__":
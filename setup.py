@@ -32,7 +32,8 @@ setup(name='ptwit',
       keywords='twitter, command-line, client',
       license='MIT',
       py_modules=['ptwit'],
-      install_requires=['python-twitter', 'click-default-group', 'click'],
+      install_requires=['python-twitter', 'click-default-group', 'click',
+                        'requests', 'urllib3>=1.26'],
       entry_points='''
       [console_scripts]
       ptwit=ptwit:cli
@@ -1,8 +1,57 @@
 import unittest
+import io
 import os
+import json
 import tempfile
+import shutil
+import threading
+import time
+from unittest import mock
 
-from ptwit import TwitterConfig
+import twitter
+import requests
+import click
+from click.testing import CliRunner
+
+import ptwit
+
+from ptwit import (
+    TwitterConfig,
+    TwitterState,
+    migrate_state,
+    count_tweets,
+    sync_messages,
+    StatusCache,
+    MediaCache,
+    download_media,
+    TweetFilter,
+    TransportAdapter,
+    iter_tweets_as_text,
+    call_concurrently,
+    lookup_users,
+    exclusive_lock,
+    read_snapshot,
+    write_snapshot,
+    fetch_threads,
+    search_tweets,
+    is_transient_error,
+    run_batch,
+    read_batch_items,
+)
+
+
+class FakeStatus:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeSearchApi:
+    def __init__(self, results):
+        self.results = results
+
+    def GetSearch(self, term=None, count=15, max_id=None, **kwargs):
+        ids = [id for id in self.results[term] if max_id is None or id <= max_id]
+        return [FakeStatus(id) for id in ids[:count]]
 
 
 class TestTwitterConfig(unittest.TestCase):
@@ -71,6 +120,834 @@ class TestTwitterConfig(unittest.TestCase):
         self.assertTrue(content.find("Tao"))
         self.assertTrue(content.find("name"))
 
+    def test_transport(self):
+        config = TwitterConfig(self.filename)
+        config.set("http_read_timeout", "5")
+        config.set("http_max_retries", "2")
+        adapter = TransportAdapter.from_config(config)
+        self.assertEqual(adapter.timeout[1], 5.0)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertFalse(adapter.max_retries.is_retry("POST", 503))
+        self.assertTrue(adapter.max_retries.is_retry("GET", 503))
+
+
+class TestSearchTweets(unittest.TestCase):
+    def test_merge_and_dedup(self):
+        api = FakeSearchApi({"foo": [9, 7, 5, 3, 1], "bar": [8, 7, 6, 5, 4]})
+        results = list(search_tweets(api, ["foo", "bar"], count=4, max_workers=2))
+        self.assertEqual([tweet.id for tweet, _ in results], [9, 8, 7, 6, 5, 3])
+        self.assertEqual(results[2][1], ["foo", "bar"])
+        self.assertEqual(results[3][1], ["bar"])
+
+    def test_failure(self):
+        api = FakeSearchApi({"foo": [3, 1], "bar": [2]})
+        failures = {}
+        tweets = search_tweets(api, ["foo", "bar", "baz"], count=4, failures=failures)
+        self.assertEqual([tweet.id for tweet, _ in tweets], [3, 2, 1])
+        self.assertIsInstance(failures["baz"], KeyError)
+
+    def test_paging(self):
+        api = FakeSearchApi({"foo": list(range(250, 0, -1))})
+        tweets = [tweet for tweet, _ in search_tweets(api, ["foo"], count=220)]
+        self.assertEqual(len(tweets), 220)
+        self.assertEqual(tweets[-1].id, 31)
+
+
+class FakeVerifyApi:
+    def VerifyCredentials(self):
+        return twitter.User.NewFromJsonDict({"id": 1, "screen_name": "me"})
+
+
+class TestLogin(unittest.TestCase):
+    def setUp(self):
+        _, self.filename = tempfile.mkstemp()
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_no_rewrite(self):
+        config = TwitterConfig(self.filename)
+        config.set("consumer_key", "ck").set("consumer_secret", "cs")
+        config.set("token_key", "tk", account="me")
+        config.set("token_secret", "ts", account="me")
+        config.set("current_account", "me").save()
+        with mock.patch("ptwit.new_api", return_value=FakeVerifyApi()):
+            with mock.patch.object(TwitterConfig, "save") as save:
+                ptwit._login(TwitterConfig(self.filename), "me")
+            save.assert_not_called()
+
+            # Switching accounts is saved
+            config.set("current_account", "other").save()
+            ptwit._login(TwitterConfig(self.filename), "me")
+        self.assertEqual(TwitterConfig(self.filename).get("current_account"), "me")
+
+
+class TestTwitterState(unittest.TestCase):
+    def setUp(self):
+        _, self.filename = tempfile.mkstemp()
+        _, self.config_filename = tempfile.mkstemp()
+
+    def tearDown(self):
+        os.remove(self.filename)
+        os.remove(self.config_filename)
+
+    def test_set(self):
+        state = TwitterState(self.filename)
+        state.set("timeline_since_id", 123, account="Tao")
+        state.set("timeline_since_id", 456, account="Tao")
+        state.set("timeline_since_id", 789, account="Mian")
+        state.close()
+        state = TwitterState(self.filename)
+        self.assertEqual(state.get("timeline_since_id", account="Tao"), "456")
+        self.assertEqual(state.get("timeline_since_id", account="Mian"), "789")
+        self.assertIsNone(state.get("mentions_since_id", account="Tao"))
+        state.unset("timeline_since_id", account="Tao")
+        self.assertIsNone(state.get("timeline_since_id", account="Tao"))
+
+    def test_migrate(self):
+        config = TwitterConfig(self.config_filename)
+        config.set("token_key", "key", account="Tao")
+        config.set("timeline_since_id", "123", account="Tao")
+        state = TwitterState(self.filename)
+        migrate_state(config, state)
+        self.assertEqual(state.get("timeline_since_id", account="Tao"), "123")
+        config = TwitterConfig(self.config_filename)
+        self.assertEqual(config.config.items("Tao"), [("token_key", "key")])
+
+    def test_stats(self):
+        state = TwitterState(self.filename)
+        tweets = [
+            make_tweet(
+                1,
+                "tao",
+                "#a @mian",
+                created_at="Mon Oct 19 08:00:00 +0000 2026",
+                entities={
+                    "hashtags": [{"text": "A"}],
+                    "user_mentions": [{"screen_name": "mian"}],
+                },
+            ),
+            make_tweet(2, "mian", created_at="Mon Oct 19 09:00:00 +0000 2026"),
+        ]
+        state.add_stats("timeline", count_tweets(tweets), account="Tao")
+        state.add_stats("search", count_tweets(tweets[:1]), account="Tao")
+        self.assertEqual(
+            state.get_stats("author", account="Tao", sources=["timeline", "search"]),
+            [("tao", 2), ("mian", 1)],
+        )
+        self.assertEqual(
+            state.get_stats("author", account="Tao", sources=["timeline"], limit=1),
+            [("mian", 1)],
+        )
+        self.assertEqual(
+            state.get_stats("hashtag", account="Tao", sources=["search"]), [("a", 1)]
+        )
+        self.assertEqual(
+            state.get_stats("hour", account="Tao", sources=["timeline"]),
+            [("08", 1), ("09", 1)],
+        )
+
+
+class FakeMessageApi:
+    def __init__(self, received, sent, fail_at=None):
+        self.received = received
+        self.sent = sent
+        self.calls = 0
+        self.fail_at = fail_at
+
+    def _page(self, messages, role, count, since_id, max_id):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise requests.ConnectionError()
+        ids = sorted(messages, reverse=True)
+        ids = [id for id in ids if since_id is None or int(since_id) < id]
+        ids = [id for id in ids if max_id is None or id <= max_id][:count]
+        return [
+            twitter.DirectMessage.NewFromJsonDict(
+                {"id": id, "text": str(id), f"{role}_screen_name": messages[id]}
+            )
+            for id in ids
+        ]
+
+    def GetDirectMessages(self, count=None, since_id=None, max_id=None):
+        return self._page(self.received, "sender", count, since_id, max_id)
+
+    def GetSentDirectMessages(self, count=None, since_id=None, max_id=None):
+        return self._page(self.sent, "recipient", count, since_id, max_id)
+
+
+class TestSyncMessages(unittest.TestCase):
+    def setUp(self):
+        _, self.filename = tempfile.mkstemp()
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_sync(self):
+        received = {id: "Tao" if id % 2 else "Mian" for id in range(1, 501)}
+        sent = {id: "Tao" for id in range(1000, 1010)}
+        api = FakeMessageApi(received, sent)
+        state = TwitterState(self.filename)
+        messages = sync_messages(api, state, "me")
+        self.assertEqual(len(messages), 500)
+        self.assertEqual(messages[0].id, 500)
+        conversation = state.get_messages("@tao", account="me")
+        self.assertEqual(len(conversation), 260)
+        self.assertEqual(conversation[0]["id"], 1009)
+
+        received[501] = "Mian"
+        self.assertEqual([m.id for m in sync_messages(api, state, "me")], [501])
+        self.assertEqual(len(state.get_messages("mian", account="me", limit=3)), 3)
+
+    def test_sync_interrupted(self):
+        received = {id: "Tao" for id in range(1, 501)}
+        api = FakeMessageApi(received, {}, fail_at=2)
+        state = TwitterState(self.filename)
+        with self.assertRaises(requests.ConnectionError):
+            sync_messages(api, state, "me")
+        conversation = state.get_messages("tao", account="me")
+        self.assertEqual(conversation[0]["id"], 500)
+        self.assertIsNone(state.get("messages_since_id", account="me"))
+
+        api.fail_at = None
+        self.assertEqual(len(sync_messages(api, state, "me")), 500)
+        self.assertEqual(int(state.get("messages_since_id", account="me")), 500)
+
+
+class FakeLookupApi:
+    def __init__(self, replies):
+        # Map status id to the id it replies to
+        self.replies = replies
+        self.lookups = []
+
+    def GetStatuses(self, status_ids, map=False):
+        self.lookups.append(sorted(status_ids))
+        return {
+            id: (
+                twitter.Status.NewFromJsonDict(
+                    {"id": id, "in_reply_to_status_id": self.replies[id]}
+                )
+                if id in self.replies
+                else None
+            )
+            for id in status_ids
+        }
+
+
+class TestFetchThreads(unittest.TestCase):
+    def setUp(self):
+        _, self.filename = tempfile.mkstemp()
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_fetch_threads(self):
+        api = FakeLookupApi({1: None, 2: 1, 3: 2, 4: 1, 5: 404})
+        cache = StatusCache(self.filename)
+        threads = fetch_threads(api, cache, [3, 4, 5])
+        self.assertEqual(
+            [[status.id for status in statuses] for statuses in threads],
+            [[1, 2, 3], [1, 4], [5]],
+        )
+        self.assertEqual(api.lookups, [[3, 4, 5], [1, 2, 404]])
+
+    def test_cache(self):
+        api = FakeLookupApi({1: None, 2: 1})
+        cache = StatusCache(self.filename)
+        fetch_threads(api, cache, [2])
+        cache.save()
+        api.lookups = []
+        cache = StatusCache(self.filename)
+        threads = fetch_threads(api, cache, [2])
+        self.assertEqual([status.id for status in threads[0]], [1, 2])
+        self.assertEqual(api.lookups, [])
+
+    def test_cache_inaccessible(self):
+        api = FakeLookupApi({2: 404})
+        cache = StatusCache(self.filename)
+        self.assertIsNone(cache.lookup(api, [404])[404])
+        cache.lookup(api, [404])
+        self.assertEqual(api.lookups, [[404]])
+        cache.save()
+        StatusCache(self.filename).lookup(api, [404])
+        self.assertEqual(api.lookups, [[404], [404]])
+
+
+class FakeFriendshipApi:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.followed = []
+        self.calls = 0
+
+    def CreateFriendship(self, screen_name=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        if screen_name == "nobody":
+            raise twitter.TwitterError([{"code": 108, "message": "Not found"}])
+        if screen_name == "slow":
+            raise requests.ReadTimeout("read timed out")
+        self.followed.append(screen_name)
+        return FakeStatus(len(self.followed))
+
+
+class TestBatch(unittest.TestCase):
+    def test_run_batch(self):
+        api = FakeFriendshipApi()
+        items = [
+            {"op": "follow", "user": "foo"},
+            {"op": "follow", "user": "nobody"},
+            {"op": "fly"},
+            {"op": "follow", "user": "bar"},
+        ]
+        results = []
+        run_batch(api, items, 1000, results.append, done={3})
+        results.sort(key=lambda r: r["index"])
+        self.assertEqual([r["status"] for r in results], ["ok", "error", "error"])
+        self.assertEqual(api.followed, ["foo"])
+
+    def test_interrupt(self):
+        api = FakeFriendshipApi(delay=0.01)
+        items = [{"op": "follow", "user": f"user{n}"} for n in range(100)]
+        results = []
+
+        def record(result):
+            results.append(result)
+            if len(results) == 1:
+                raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            run_batch(api, items, 1000, record, max_workers=2)
+        calls = api.calls
+        self.assertLess(calls, 10)
+        # Every operation that ran is recorded
+        self.assertEqual(len(results), calls)
+        time.sleep(0.05)
+        self.assertEqual(api.calls, calls)
+
+    def test_invalid_items(self):
+        lines = io.StringIO('{"op": "follow", "user": "foo"}\noops\n[1]\n')
+        results = []
+        run_batch(FakeFriendshipApi(), read_batch_items(lines), 1000, results.append)
+        results.sort(key=lambda r: r["index"])
+        self.assertEqual([r["status"] for r in results], ["ok", "error", "error"])
+
+    def test_no_retry_writes_on_timeout(self):
+        api = FakeFriendshipApi()
+        items = [{"op": "follow", "user": "slow"}]
+        results = []
+        run_batch(api, items, 1000, results.append)
+        self.assertEqual(results[0]["status"], "error")
+        self.assertEqual(api.calls, 1)
+
+    def test_is_transient_error(self):
+        self.assertFalse(
+            is_transient_error(twitter.TwitterError([{"code": 88, "message": ""}]))
+        )
+        self.assertTrue(is_transient_error(requests.ReadTimeout()))
+        self.assertFalse(is_transient_error(requests.ReadTimeout(), idempotent=False))
+        self.assertTrue(is_transient_error(requests.ConnectTimeout(), idempotent=False))
+        self.assertTrue(
+            is_transient_error(twitter.TwitterError({"message": "Capacity Error"}))
+        )
+        self.assertFalse(
+            is_transient_error(twitter.TwitterError([{"code": 108, "message": ""}]))
+        )
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        return [self.content]
+
+
+class FakeSession:
+    def __init__(self):
+        self.urls = []
+        self.closed = False
+
+    def get(self, url, stream=False):
+        self.urls.append(url)
+        if "missing" in url:
+            raise requests.HTTPError("404 Client Error")
+        return FakeResponse(url.encode("utf-8") * 10)
+
+    def close(self):
+        self.closed = True
+
+
+class TestMediaCache(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_download(self):
+        session = FakeSession()
+        cache = MediaCache(self.dirname)
+        path = cache.download(session, "https://a/1.jpg")
+        self.assertTrue(path.endswith(".jpg"))
+        cache.save()
+        cache = MediaCache(self.dirname)
+        self.assertEqual(cache.download(session, "https://a/1.jpg"), path)
+        self.assertEqual(session.urls, ["https://a/1.jpg"])
+
+    def test_evict(self):
+        session = FakeSession()
+        cache = MediaCache(self.dirname, max_size=300)
+        paths = [cache.download(session, f"https://a/{n}.jpg") for n in range(3)]
+        os.utime(paths[0], (0, 0))
+        cache.evict()
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertIsNone(cache.get("https://a/0.jpg"))
+        self.assertEqual(cache.get("https://a/1.jpg"), paths[1])
+
+    def test_evict_orphans(self):
+        cache = MediaCache(self.dirname)
+        path = cache.download(FakeSession(), "https://a/1.jpg")
+        orphans = [os.path.join(self.dirname, name) for name in ("x.tmp", "y.jpg")]
+        for orphan in orphans:
+            with open(orphan, "w") as fp:
+                fp.write("x" * 1000)
+        young = os.path.join(self.dirname, "z.tmp")
+        open(young, "w").close()
+        for orphan in orphans:
+            os.utime(orphan, (0, 0))
+        cache.evict()
+        self.assertEqual([os.path.exists(orphan) for orphan in orphans], [False, False])
+        self.assertTrue(os.path.exists(young))
+        self.assertTrue(os.path.exists(path))
+
+    def test_save_merges(self):
+        caches = [MediaCache(self.dirname), MediaCache(self.dirname)]
+        for n, cache in enumerate(caches):
+            cache.download(FakeSession(), f"https://a/{n}.jpg")
+        for cache in caches:
+            cache.save()
+        cache = MediaCache(self.dirname)
+        self.assertIsNotNone(cache.get("https://a/0.jpg"))
+        self.assertIsNotNone(cache.get("https://a/1.jpg"))
+
+    def test_download_media(self):
+        session = FakeSession()
+        cache = MediaCache(self.dirname)
+        urls = ["https://a/1.jpg", "https://a/2.jpg"]
+        paths = download_media(cache, urls, session)
+        self.assertEqual([cache.get(url) for url in urls], paths)
+        self.assertFalse(session.closed)
+
+    def test_download_media_failure(self):
+        session = FakeSession()
+        cache = MediaCache(self.dirname)
+        urls = ["https://a/1.jpg", "https://a/missing.jpg", "https://a/2.jpg"]
+        results = download_media(cache, urls, session)
+        self.assertIsInstance(results[1], requests.HTTPError)
+        cache = MediaCache(self.dirname)
+        self.assertEqual(cache.get(urls[0]), results[0])
+        self.assertEqual(cache.get(urls[2]), results[2])
+        self.assertIsNone(cache.get(urls[1]))
+
+
+def make_tweet(id, screen_name, text="", **kwargs):
+    data = {
+        "id": id,
+        "text": text,
+        "user": {"name": screen_name.title(), "screen_name": screen_name},
+    }
+    data.update(kwargs)
+    return twitter.Status.NewFromJsonDict(data)
+
+
+class TestTweetFilter(unittest.TestCase):
+    def test_filter(self):
+        tweet_filter = TweetFilter(
+            users=["@Spam"],
+            keywords=["buy now"],
+            regexes=[r"\bcrypto\w*"],
+            hashtags=["#ad"],
+            retweets_from=["loud"],
+            replies_from=["*"],
+        )
+        tweets = [
+            make_tweet(1, "spam", "hello"),
+            make_tweet(2, "tao", "BUY NOW!"),
+            make_tweet(3, "tao", "cryptocurrency"),
+            make_tweet(4, "tao", "#Ad", entities={"hashtags": [{"text": "Ad"}]}),
+            make_tweet(5, "loud", retweeted_status={"id": 0, "text": "hi"}),
+            make_tweet(6, "tao", "reply", in_reply_to_status_id=1),
+            make_tweet(7, "tao", "hello"),
+            make_tweet(8, "mian", retweeted_status=make_tweet(0, "spam").AsDict()),
+        ]
+        self.assertEqual([tweet.id for tweet in tweet_filter.filter(tweets)], [7])
+
+    def test_from_config(self):
+        _, filename = tempfile.mkstemp()
+        config = TwitterConfig(filename)
+        config.set("mute_keywords", "foo, bar", account="Tao")
+        config.set("mute_regexes", "a{1,2}b\nxyz", account="Tao")
+        tweet_filter = TweetFilter.from_config(config, "Tao")
+        os.remove(filename)
+        self.assertTrue(tweet_filter)
+        self.assertFalse(TweetFilter())
+        tweets = [
+            make_tweet(n, "tao", text) for n, text in enumerate(["BAR", "aab", "ok"])
+        ]
+        self.assertEqual([tweet.text for tweet in tweet_filter.filter(tweets)], ["ok"])
+
+    def test_patterns(self):
+        tweet_filter = TweetFilter(
+            keywords=["cat", "a&b"], regexes=["(?i)dog", r"(\w)\1{3}"]
+        )
+        tweets = [
+            make_tweet(n, "tao", text)
+            for n, text in enumerate(
+                ["concatenate", "Cat!", "a&amp;b", "DOG", "zzzz", "zz"]
+            )
+        ]
+        self.assertEqual(
+            [tweet.text for tweet in tweet_filter.filter(tweets)], ["concatenate", "zz"]
+        )
+
+    def test_invalid_regex(self):
+        _, filename = tempfile.mkstemp()
+        config = TwitterConfig(filename)
+        config.set("mute_regexes", "ok\nfoo(", account="Tao")
+        with self.assertRaises(click.ClickException) as cm:
+            TweetFilter.from_config(config, "Tao")
+        os.remove(filename)
+        self.assertIn("'foo('", cm.exception.message)
+        self.assertIn("mute_regexes", cm.exception.message)
+
+
+class TestRender(unittest.TestCase):
+    def test_parallel(self):
+        tweets = [
+            make_tweet(
+                n,
+                f"user{n}",
+                f"tweet {n} #tag",
+                created_at="Mon Oct 19 08:00:00 +0000 2020",
+                entities={"hashtags": [{"text": "tag"}]},
+            )
+            for n in range(50)
+        ]
+        self.assertEqual(
+            list(iter_tweets_as_text(tweets, jobs=2, threshold=10)),
+            list(iter_tweets_as_text(tweets)),
+        )
+
+
+class FakeUserApi:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def GetUser(self, screen_name=None):
+        if screen_name == "nobody":
+            raise twitter.TwitterError([{"code": 50, "message": "User not found."}])
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= 1
+        return screen_name
+
+    def UsersLookup(self, user_id=None):
+        if 0 in user_id:
+            raise twitter.TwitterError([{"code": 17, "message": "No user matches."}])
+        return [FakeStatus(id) for id in reversed(user_id) if id % 7]
+
+
+class TestCallConcurrently(unittest.TestCase):
+    def test_call(self):
+        api = FakeUserApi()
+        users = [f"user{n}" for n in range(20)]
+        self.assertEqual(
+            call_concurrently(
+                api, "GetUser", [{"screen_name": user} for user in users], max_workers=4
+            ),
+            users,
+        )
+        self.assertLessEqual(api.max_in_flight, 4)
+        self.assertLess(1, api.max_in_flight)
+
+    def test_failures(self):
+        users = ["tao", "nobody", "mian"]
+        results = call_concurrently(
+            FakeUserApi(), "GetUser", [{"screen_name": user} for user in users]
+        )
+        self.assertEqual(results[0], "tao")
+        self.assertIsInstance(results[1], twitter.TwitterError)
+        self.assertEqual(results[2], "mian")
+
+    def test_lookup_users(self):
+        user_ids = list(range(1, 251))
+        users = lookup_users(FakeUserApi(), user_ids)
+        self.assertEqual([user.id for user in users], [id for id in user_ids if id % 7])
+
+        # Users of the other batches are still returned
+        users = lookup_users(FakeUserApi(), [0] + user_ids)
+        self.assertEqual(len(users), len([id for id in user_ids[99:] if id % 7]))
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_snapshot(self):
+        filename = os.path.join(self.dirname, "timeline.json")
+        self.assertIsNone(read_snapshot(filename))
+        write_snapshot(filename, [make_tweet(2, "tao"), make_tweet(1, "mian")])
+        snapshot = read_snapshot(filename)
+        self.assertEqual([tweet.id for tweet in snapshot], [2, 1])
+        self.assertEqual(snapshot[1].user.screen_name, "mian")
+
+    def test_lock(self):
+        filename = os.path.join(self.dirname, "timeline.lock")
+        with exclusive_lock(filename) as acquired:
+            self.assertTrue(acquired)
+            with exclusive_lock(filename) as acquired_again:
+                self.assertFalse(acquired_again)
+            self.assertTrue(os.path.exists(filename))
+        self.assertFalse(os.path.exists(filename))
+        # A stale lock is taken over
+        open(filename, "w").close()
+        os.utime(filename, (0, 0))
+        with exclusive_lock(filename) as acquired:
+            self.assertTrue(acquired)
+
+
+class FakeTimelineApi:
+    def __init__(self, tweets):
+        self.tweets = tweets
+        self.fetches = []
+
+    def GetHomeTimeline(self, count=None, since_id=None):
+        self.fetches.append(since_id)
+        tweets = sorted(self.tweets, key=lambda tweet: tweet.id, reverse=True)
+        return [t for t in tweets if since_id is None or int(since_id) < t.id][:count]
+
+
+class CliTestCase(unittest.TestCase):
+    """Run commands with the app dir in a temporary directory and a fake
+    API instead of logging in."""
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dirname)
+        self.api = None
+        self.logins = 0
+        config = TwitterConfig(os.path.join(self.dirname, "ptwit.conf"))
+        config.set("current_account", "me")
+        self.configure(config)
+        config.save()
+        self.patch("click.get_app_dir", return_value=self.dirname)
+        self.patch("ptwit._login", side_effect=self.login)
+
+    def patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def configure(self, config):
+        pass
+
+    def login(self, config, account=None, adapter=None):
+        self.logins += 1
+        return self.api
+
+    def invoke(self, *args, **kwargs):
+        return CliRunner().invoke(ptwit.ptwit, list(args), **kwargs)
+
+
+class TestTimelineSnapshot(CliTestCase):
+    def configure(self, config):
+        config.set("timeline_snapshot", "yes", account="me")
+
+    def test_timeline(self):
+        created_at = "Mon Oct 19 10:00:00 +0000 2020"
+        tweets = [
+            make_tweet(1, "tao", "first", created_at="Mon Oct 19 08:00:00 +0000 2020")
+        ]
+        self.api = FakeTimelineApi(tweets)
+        spawn = self.patch("ptwit.spawn_detached")
+        self.patch("ptwit.stored_api", return_value=self.api)
+
+        # No snapshot yet: fetch now
+        result = self.invoke("timeline")
+        self.assertIn("first", result.output)
+        self.assertEqual(self.logins, 1)
+        spawn.assert_not_called()
+
+        # Serve the (empty) snapshot without logging in, and refresh
+        result = self.invoke("timeline")
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(result.output, "")
+        self.assertEqual(self.logins, 1)
+        spawn.assert_called_once_with(["--account", "me", "refresh-timeline"])
+
+        tweets.append(
+            make_tweet(2, "tao", "second", created_at="Mon Oct 19 09:00:00 +0000 2020")
+        )
+        result = self.invoke("refresh-timeline")
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(self.api.fetches, [None, "1"])
+        self.assertEqual(self.logins, 1)
+
+        result = self.invoke("timeline")
+        self.assertIn("second", result.output)
+        self.assertNotIn("first", result.output)
+        self.assertEqual(self.logins, 1)
+
+        # --fresh fetches now, after the since id saved by the refresh
+        result = self.invoke("timeline", "--fresh")
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(self.logins, 2)
+        self.assertEqual(self.api.fetches, [None, "1", "2"])
+
+        # Shown tweets are not shown again, and refreshes add up until
+        # the snapshot is shown
+        self.assertEqual(self.invoke("timeline").output, "")
+        for id, text in ((3, "third"), (4, "fourth")):
+            tweets.append(make_tweet(id, "tao", text, created_at=created_at))
+            self.invoke("refresh-timeline")
+        result = self.invoke("timeline")
+        self.assertIn("third", result.output)
+        self.assertIn("fourth", result.output)
+
+        # Tweets shown by --fresh are skipped in a snapshot written by
+        # a refresh running meanwhile
+        tweets.append(make_tweet(5, "tao", "fifth", created_at=created_at))
+        self.assertIn("fifth", self.invoke("timeline", "--fresh").output)
+        write_snapshot(os.path.join(self.dirname, "timeline-me.json"), tweets[-1:])
+        self.assertEqual(self.invoke("timeline").output, "")
+
+    def test_refresh_failure(self):
+        tweets = [make_tweet(1, "tao", "first")]
+        self.patch("ptwit.stored_api", return_value=FakeTimelineApi(tweets))
+        self.patch("ptwit.write_snapshot", side_effect=OSError("disk full"))
+        result = self.invoke("refresh-timeline")
+        self.assertIsInstance(result.exception, OSError)
+        state = TwitterState(os.path.join(self.dirname, "state.sqlite3"))
+        self.assertIsNone(state.get("timeline_since_id", account="me"))
+
+
+class FakeQueryApi:
+    def __init__(self, results):
+        self.results = results
+
+    def GetSearch(self, term=None, count=15, max_id=None, **kwargs):
+        return self.results[term.strip().lower()] if max_id is None else []
+
+
+class TestSearchStats(CliTestCase):
+    def test_stats_per_query(self):
+        created_at = "Mon Oct 19 08:00:00 +0000 2026"
+        self.api = FakeQueryApi(
+            {
+                "a": [make_tweet(2, "tao", "a", created_at=created_at)],
+                "b": [make_tweet(1, "mian", "b", created_at=created_at)],
+            }
+        )
+        for args in (["-q", "a"], ["-q", "a", "-q", "b"], ["-q", " A "]):
+            result = self.invoke("search", *args)
+            self.assertEqual(result.exit_code, 0, result.output)
+        state = TwitterState(os.path.join(self.dirname, "state.sqlite3"))
+        self.assertEqual(
+            dict(state.get_stats("author", "me", ["search"])), {"tao": 1, "mian": 1}
+        )
+
+        # A failed query is reported, and the others are still shown
+        result = self.invoke("search", "-q", "a", "-q", "missing")
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Failed to search missing", result.output)
+        self.assertIn("tao", result.output)
+
+        # Stats are local, so showing them does not log in
+        logins = self.logins
+        result = self.invoke("stats")
+        self.assertIn("tao", result.output)
+        self.assertEqual(self.logins, logins)
+
+
+class FakeBrokenApi:
+    def VerifyCredentials(self):
+        raise RuntimeError("broken")
+
+
+class TestShell(CliTestCase):
+    def test_shell(self):
+        self.api = FakeBrokenApi()
+        result = self.invoke("shell", input='whois\nnosuch\nsearch "a\nstats\nexit\n')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Error: broken", result.output)
+        self.assertIn('No such command "nosuch"', result.output)
+        self.assertIn("No closing quotation", result.output)
+        self.assertEqual(result.output.count("me> "), 5)
+        self.assertEqual(self.logins, 1)
+
+
+class FakeWhoisApi:
+    def GetUser(self, screen_name=None):
+        if screen_name == "nobody":
+            raise twitter.TwitterError([{"code": 50, "message": "User not found."}])
+        return twitter.User.NewFromJsonDict({"id": 1, "screen_name": screen_name})
+
+
+class TestWhois(CliTestCase):
+    def test_partial_failure(self):
+        self.api = FakeWhoisApi()
+        result = self.invoke("--json", "whois", "nobody", "tao")
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Failed to get nobody", result.output)
+        self.assertIn('"screen_name": "tao"', result.output)
+
+
+class FakePostApi:
+    def __init__(self):
+        self.posted = []
+
+    def PostUpdate(self, text):
+        self.posted.append(text)
+        return FakeStatus(len(self.posted))
+
+
+class TestBatchCommand(CliTestCase):
+    def test_resume(self):
+        self.api = FakePostApi()
+        log = os.path.join(self.dirname, "log.ndjson")
+        lines = [json.dumps({"op": "post", "text": str(n)}) for n in range(5)]
+        result = self.invoke(
+            "batch", "--log", log, "--rate", "1000", input="\n".join(lines + ["oops"])
+        )
+        self.assertEqual(result.exit_code, 1, result.output)
+        self.assertIn("1 operations failed", result.output)
+        self.assertEqual(len(self.api.posted), 5)
+
+        # Resuming only retries the failed line
+        result = self.invoke(
+            "batch", "--log", log, "--rate", "1000", input="\n".join(lines + ["{}"])
+        )
+        self.assertEqual(len(self.api.posted), 5)
+        with open(log) as fp:
+            self.assertEqual(len(fp.readlines()), 7)
+
 
 if __name__ == "__main__":
     unittest.main()